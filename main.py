@@ -1,14 +1,24 @@
 # Steven Au
 
 from flask import Flask, jsonify
-from src import load, boats, auth, users, welcome
+from src import load, boats, auth, users, welcome, limiter, warmup, tasks, admin, unit_of_work, compression, profiler, changes
 
 app = Flask(__name__)
+# Registered first so it compresses the response after every other after_request hook
+app.register_blueprint(compression.bp)
+# Registered next so the recorded time includes the other after_request hooks
+app.register_blueprint(profiler.bp)
+app.register_blueprint(limiter.bp)
+app.register_blueprint(unit_of_work.bp)
 app.register_blueprint(welcome.bp)
 app.register_blueprint(users.bp)
 app.register_blueprint(boats.bp)
 app.register_blueprint(load.bp)
+app.register_blueprint(changes.bp)
 app.register_blueprint(auth.bp)
+app.register_blueprint(warmup.bp)
+app.register_blueprint(tasks.bp)
+app.register_blueprint(admin.bp)
 
 app.config['SECRET_KEY'] = 'someSecret493'
 
@@ -0,0 +1,48 @@
+""" Operational endpoints for the maintainers.
+    Every route requires the admin secret from constants.py in the X-Admin-Secret header.
+"""
+import hmac
+
+from flask import Blueprint, current_app, request, send_from_directory
+from src import constants
+from src import listing_cache
+from src import profiler
+from src import tasks
+
+bp = Blueprint('admin', __name__, url_prefix='/admin')
+
+
+@bp.before_request
+def require_admin():
+    secret = request.headers.get('X-Admin-Secret', '')
+    if not constants.admin_secret or not hmac.compare_digest(secret, constants.admin_secret):
+        error_message = {
+            "Error": "Admin access required"
+        }
+        return error_message, 403
+    return None
+
+
+@bp.route('/tasks', methods=['GET'])
+def task_metrics():
+    """ Progress of the background task queue."""
+    return tasks.get_metrics(), 200
+
+
+@bp.route('/cache', methods=['GET'])
+def cache_metrics():
+    """ Hit rate of the listing cache."""
+    return listing_cache.get_metrics(), 200
+
+
+@bp.route('/slow-requests', methods=['GET'])
+def slow_requests():
+    """ Recent requests over the profiler threshold, newest last."""
+    return {"slow_requests": profiler.recent()}, 200
+
+
+@bp.route('/profiles/<name>', methods=['GET'])
+def profile_file(name):
+    """ A folded stack profile written for a slow request."""
+    profile_dir = current_app.config.get('PROFILE_DIR', profiler.PROFILE_DIR)
+    return send_from_directory(profile_dir, name, mimetype='text/plain')
@@ -0,0 +1,13 @@
+""" The per-boat load aggregates stored on every boat, maintained by src/aggregates.py.
+    Builds no datastore client, so offline tools like the seeder can import it.
+"""
+
+FIELDS = ("load_count", "total_volume")
+
+
+def initial():
+    """ Aggregates of a boat that carries nothing."""
+    return {
+        "load_count": 0,
+        "total_volume": 0
+    }
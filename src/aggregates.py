@@ -0,0 +1,93 @@
+""" Per-boat load aggregates.
+    Every boat stores the number of loads it carries and their total volume as indexed attributes.
+    They are adjusted through the unit of work in the same transaction as the load write that changes
+    them, so capacity listings like GET /boats?sort=-total_volume are plain indexed queries.
+
+    Recompute them from the loads with: python -m src.aggregates --reconcile [--dry-run]
+"""
+import argparse
+import collections
+
+from google.cloud import datastore
+from src import aggregate_fields
+from src import constants
+from src import listing_cache
+from src import sequence
+from src import unit_of_work
+
+client = datastore.Client()
+
+
+def read_load(load):
+    """ The attributes of a load the deltas are computed from, as read by the handler.
+        Pass them to unit.expect so the deltas are only written if the load is unchanged at commit.
+    """
+    return {
+        "carrier": unit_of_work.plain(load["carrier"]),
+        "volume": load["volume"]
+    }
+
+
+def adjust(unit, boat_id, count, volume):
+    """ Register a change of a boat's aggregates with the unit of work of the request."""
+    if count == 0 and volume == 0:
+        return
+    boat_key = client.key(constants.boats, int(boat_id))
+    unit.increment(boat_key, load_count=count, total_volume=volume)
+    # The boat may belong to another owner, who is only known once the flush has read it
+    unit.on_commit(lambda: invalidate_owner(unit, boat_key))
+
+
+def invalidate_owner(unit, boat_key):
+    """ Drop the cached listings of the owner of a boat whose aggregates were adjusted."""
+    boat = unit.stored_entity(boat_key)
+    if boat is not None:
+        listing_cache.invalidate(boat["owner"])
+
+
+def totals():
+    """ Aggregates of every boat carrying at least one load, computed from the loads."""
+    boat_totals = collections.defaultdict(aggregate_fields.initial)
+    for each_load in client.query(kind=constants.load).fetch():
+        if each_load["carrier"] is not None:
+            boat_total = boat_totals[each_load["carrier"]["id"]]
+            boat_total["load_count"] += 1
+            boat_total["total_volume"] += each_load["volume"]
+    return boat_totals
+
+
+def reconcile(batch=500, dry_run=False):
+    """ Rewrite the aggregates of every boat that disagrees with its loads and return how many were fixed.
+        Each batch is re-read in a transaction so concurrent edits to the boats are kept. Loads changed
+        while the scan runs can still be missed - run it again, or during low traffic.
+    """
+    boat_totals = totals()
+    stale = []
+    for boat in client.query(kind=constants.boats).fetch():
+        expected = boat_totals.get(boat.key.id, aggregate_fields.initial())
+        if any(boat.get(field) != expected[field] for field in aggregate_fields.FIELDS):
+            stale.append(boat.key)
+
+    if not dry_run:
+        for start in range(0, len(stale), batch):
+            with client.transaction():
+                boats_results = client.get_multi(stale[start:start + batch])
+                for boat in boats_results:
+                    boat.update(boat_totals.get(boat.key.id, aggregate_fields.initial()))
+                sequence.stamp(*boats_results)
+                client.put_multi(boats_results)
+
+    return len(stale)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Maintain the per-boat load aggregates")
+    parser.add_argument("--reconcile", action="store_true", help="recompute the aggregates of every boat from its loads")
+    parser.add_argument("--batch", type=int, default=500, help="boats per transaction")
+    parser.add_argument("--dry-run", action="store_true", help="report without writing")
+    args = parser.parse_args()
+
+    if args.reconcile:
+        print("Boats with stale aggregates: " + str(reconcile(batch=args.batch, dry_run=args.dry_run)))
+    else:
+        parser.print_help()
@@ -1,8 +1,9 @@
-from flask import request, session, Blueprint, redirect, url_for
+from flask import request, session, Blueprint, redirect, url_for, g
 from google.cloud import datastore
 import requests
 import json
-from six.moves.urllib.request import urlopen
+import threading
+import time
 from jose import jwt
 
 from src import constants
@@ -11,6 +12,16 @@ from src import constants
 client = datastore.Client()
 bp = Blueprint('auth', __name__)
 
+# Pooled HTTPS connections to Auth0, shared by every request on the instance
+auth0 = requests.Session()
+auth0.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+# Signing keys change rarely - cache them and only refetch on expiry or an unknown key id
+JWKS_TTL = 3600
+JWKS_MIN_REFRESH = 60
+jwks_cache = {"jwks": None, "fetched": 0}
+jwks_lock = threading.Lock()
+
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -18,6 +29,38 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+def get_jwks(refresh=False):
+    """ Return the Auth0 JWKS from the instance cache, fetching it when missing or expired.
+        A forced refresh is ignored if the keys were fetched moments ago.
+    """
+    def stale():
+        age = time.monotonic() - jwks_cache["fetched"]
+        return jwks_cache["jwks"] is None or age > JWKS_TTL or (refresh and age > JWKS_MIN_REFRESH)
+
+    if stale():
+        with jwks_lock:
+            # Requests that waited on the lock use the keys the first one fetched
+            if stale():
+                response = auth0.get("https://" + constants.domain + "/.well-known/jwks.json", timeout=10)
+                response.raise_for_status()
+                jwks_cache["jwks"] = response.json()
+                jwks_cache["fetched"] = time.monotonic()
+    return jwks_cache["jwks"]
+
+
+def find_rsa_key(jwks, kid):
+    for key in jwks["keys"]:
+        if key["kid"] == kid:
+            return {
+                "kty": key["kty"],
+                "kid": key["kid"],
+                "use": key["use"],
+                "n": key["n"],
+                "e": key["e"]
+            }
+    return {}
+
+
 # Verify the JWT in the request's Authorization header
 def verify_jwt(request):
     if 'Authorization' in request.headers:
@@ -28,8 +71,11 @@ def verify_jwt(request):
                          "description":
                              "Authorization header is missing"}, 401)
 
-    jsonurl = urlopen("https://" + constants.domain + "/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+    # The limiter and the route may both verify the token, it is only verified once per request
+    verified = g.get('verified_jwt')
+    if verified is not None and verified[0] == token:
+        return verified[1]
+
     try:
         unverified_header = jwt.get_unverified_header(token)
     except jwt.JWTError:
@@ -42,16 +88,10 @@ def verify_jwt(request):
                          "description":
                              "Invalid header. "
                              "Use an RS256 signed JWT Access Token"}, 401)
-    rsa_key = {}
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"]
-            }
+    rsa_key = find_rsa_key(get_jwks(), unverified_header["kid"])
+    if not rsa_key:
+        # The signing keys may have been rotated since they were cached
+        rsa_key = find_rsa_key(get_jwks(refresh=True), unverified_header["kid"])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -75,6 +115,7 @@ def verify_jwt(request):
                                  "Unable to parse authentication"
                                  " token."}, 401)
 
+        g.verified_jwt = (token, payload)
         return payload
     else:
         raise AuthError({"code": "no_rsa_key",
@@ -82,6 +123,14 @@ def verify_jwt(request):
                              "No RSA key in JWKS"}, 401)
 
 
+def verify_jwt_optional(request):
+    """ Verify the JWT if one was sent, otherwise return None for public access."""
+    try:
+        return verify_jwt(request)
+    except:
+        return None
+
+
 # Generate a JWT from the Auth0 domain and return it
 # Request: JSON body with 2 properties with "username" and "password"
 #       of a user registered with this Auth0 domain
@@ -100,15 +149,17 @@ def login_user():
     content = request.get_json()
     username = content["username"]
     password = content["password"]
+    # offline_access returns a refresh token so clients can renew through /token/refresh
     body = {'grant_type': 'password',
             'username': username,
             'password': password,
             'client_id': constants.client_id,
-            'client_secret': constants.client_secret
+            'client_secret': constants.client_secret,
+            'scope': 'openid offline_access'
             }
     headers = {'content-type': 'application/json'}
     url = 'https://' + constants.domain + '/oauth/token'
-    r = requests.post(url, json=body, headers=headers)
+    r = auth0.post(url, json=body, headers=headers)
 
     # Add user to datastore if there is a valid login
     try:
@@ -128,6 +179,38 @@ def login_user():
     return r.text, 200, {'Content-Type': 'application/json'}
 
 
+@bp.route('/token/refresh', methods=['POST'])
+def refresh_token():
+    """ Exchange a refresh token for a new JWT.
+        Skips the password grant, the decode and the user upsert - the user was stored at login.
+    """
+    # Check accept header for json
+    if 'application/json' not in request.accept_mimetypes:
+        error_message = {
+            "Error": "Client must accept valid JSON"
+        }
+        return error_message, 406
+
+    content = request.get_json(silent=True)
+    if not isinstance(content, dict) or not isinstance(content.get("refresh_token"), str):
+        error_message = {
+            "Error": "The request object is missing the refresh_token attribute"
+        }
+        return error_message, 400
+
+    body = {'grant_type': 'refresh_token',
+            'refresh_token': content["refresh_token"],
+            'client_id': constants.client_id,
+            'client_secret': constants.client_secret
+            }
+    headers = {'content-type': 'application/json'}
+    url = 'https://' + constants.domain + '/oauth/token'
+    r = auth0.post(url, json=body, headers=headers, timeout=10)
+
+    # Auth0 errors (e.g. a revoked refresh token) are passed through with their status
+    return r.text, r.status_code, {'Content-Type': 'application/json'}
+
+
 @bp.route('/register', methods=['POST'])
 def register_user():
     """ Register users from welcome page.
@@ -153,7 +236,7 @@ def register_user():
             }
     headers = {'content-type': 'application/json'}
     url = 'https://' + constants.domain + '/dbconnections/signup'
-    r = requests.post(url, json=body, headers=headers)
+    r = auth0.post(url, json=body, headers=headers)
 
     # Add user to datastore if user does not exist but has a valid registration
     try:
@@ -1,27 +1,86 @@
-from flask import Blueprint, request
+import asyncio
+import functools
+from urllib.parse import urlencode
+
+from flask import Blueprint, g, request
 from google.cloud import datastore
 from src import constants
-from src import auth
+from src import aggregate_fields
+from src import aggregates
+from src import carriers
+from src import filters
+from src import gate
+from src import idempotency
+from src import listing_cache
+from src import pool
+from src import search
+from src import search_tokens
+from src import sequence
+from src import tombstones
+from src import unit_of_work
 
 client = datastore.Client()
 bp = Blueprint('boats', __name__, url_prefix='/boats')
 
 
+async def list_boats(query, args, base_url, host_url, count_query=None):
+    """ Build a page of the boats listing.
+        Does not use the flask request so stale pages can be rebuilt in the background.
+        total counts count_query when one is given.
+    """
+    # Pagination details
+    query_limit = int(args.get('limit', '5'))
+    query_offset = int(args.get('offset', '0'))
+
+    boat_iterator = query.fetch(limit=query_limit, offset=query_offset)
+    pages = boat_iterator.pages
+
+    # The page and the total are independent, fetch them concurrently
+    if count_query is None:
+        count_query = client.query(kind=constants.boats)
+    results, count_results = await asyncio.gather(
+        pool.run(lambda: list(next(pages))),
+        pool.run(lambda: len(list(count_query.fetch())))
+    )
+
+    # Pagination token condition
+    if boat_iterator.next_page_token:
+        next_offset = query_offset + query_limit
+        # Keep the filters and sort on the next page
+        next_args = {"limit": query_limit, "offset": next_offset}
+        next_args.update((key, value) for key, value in args.items() if key not in next_args)
+        next_url = base_url + "?" + urlencode(next_args)
+    else:
+        next_url = None
+
+    # Assemble the loads of every boat on the page concurrently from the carrier references
+    boat_loads = await asyncio.gather(
+        *(pool.run(carriers.loads_for_boat, entry.key.id, host_url) for entry in results)
+    )
+
+    # Create the data per the pages
+    for entry, entry_loads in zip(results, boat_loads):
+        entry["id"] = entry.key.id
+        entry["self"] = host_url + "boats/" + str(entry.key.id)
+        entry["loads"] = entry_loads
+        search_tokens.hide(entry)
+
+    output = {"boats": results}
+
+    if next_url:
+        output["next"] = next_url
+
+    output["total"] = count_results
+
+    return output
+
+
 @bp.route('', methods=['POST', 'GET', 'PATCH', 'DELETE', 'PUT'])
-def boats_all():
+@gate.guard(['GET', 'POST'], login=['POST'], optional_login=['GET'])
+async def boats_all():
     """ Boats get and post route. """
-    # Check accept header for json
-    if 'application/json' not in request.accept_mimetypes:
-        error_message = {
-            "Error": "Client must accept valid JSON"
-        }
-        return error_message, 406
-
     if request.method == 'POST':
-        try:
-            payload = auth.verify_jwt(request)
-        except:
-            return auth.verify_jwt(request)
+        payload = g.jwt_payload
 
         # In the event that all headers indicate JSON but the content is not formatted as JSON.
         try:
@@ -32,6 +91,13 @@ def boats_all():
             }
             return error_message, 415
 
+        # A retried request gets the response of the original back instead of a duplicate
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key:
+            replayed = idempotency.replay(payload["sub"], "boats", idempotency_key, content)
+            if replayed is not None:
+                return replayed
+
         # If there are any missing attributes from the expected 3 - no need to assume extraneous attributes.
         if len(content) < 3:
             error_message = {
@@ -45,9 +111,10 @@ def boats_all():
                 "name": content["name"],
                 "type": content["type"],
                 "length": content["length"],
-                "loads": [],
                 "owner": payload["sub"]
             }
+            # A new boat carries nothing
+            boat_data.update(aggregate_fields.initial())
         except:
             error_message = {
                 "Error": "The request object is missing at least one of the required attributes"
@@ -68,91 +135,96 @@ def boats_all():
             }
             return error_message, 400
 
+        # Stamped on the data so the response carries updated_at too
+        sequence.stamp(boat_data)
         new_boat = datastore.entity.Entity(key=client.key(constants.boats))
-
         new_boat.update(boat_data)
-        client.put(new_boat)
+        search_tokens.index(new_boat, constants.boats)
+
+        def created(boat_id):
+            # Add in the additional post creation data (ID is None until the put is performed)
+            boat_data["id"] = boat_id
+            # Loads are never stored on the boat - a new boat carries nothing
+            boat_data["loads"] = []
+            # Generating self on the fly - self is never stored
+            boat_data["self"] = request.base_url + "/" + str(boat_id)
+            return boat_data, 201
+
+        if idempotency_key:
+            response = idempotency.create(new_boat, payload["sub"], "boats", idempotency_key, content, created)
+        else:
+            client.put(new_boat)
+            response = created(new_boat.key.id)
 
-        # Add in the additional post creation data (ID is None until the put is performed)
-        boat_data["id"] = new_boat.key.id
-        # Generating self on the fly - self is never stored
-        boat_data["self"] = request.base_url + "/" + str(new_boat.key.id)
-        return boat_data, 201
+        listing_cache.invalidate(payload["sub"])
+        return response
 
     # Get all paginated
-    elif request.method == 'GET':
+    else:   # Get
         # If login valid, show specific owner's boats.
         #   Else, all boats in collection
         query = client.query(kind=constants.boats)
-        try:
-            payload = auth.verify_jwt(request)
-
-            # datastore query filtering
-            # https://cloud.google.com/datastore/docs/concepts/queries#datastore-datastore-basic-query-python
-            query.add_filter("owner", "=", payload["sub"])
-
-        except:
-            # If the verification jwt failed, then there won't be a filter applied to the query
-            #   In this event, all boats are shown to the user and not the ones owned by the boat owner itself
-            pass    # Therefore, pass
-
-        # Pagination details
-        query_limit = int(request.args.get('limit', '5'))
-        query_offset = int(request.args.get('offset', '0'))
-
-        boat_iterator = query.fetch(limit=query_limit, offset=query_offset)
-        pages = boat_iterator.pages
+        # If the verification jwt failed, then there won't be a filter applied to the query
+        #   In this event, all boats are shown to the user and not the ones owned by the boat owner itself
+        payload = g.jwt_payload
+        owner = payload["sub"] if payload else None
 
-        results = list(next(pages))
+        # datastore query filtering
+        # https://cloud.google.com/datastore/docs/concepts/queries#datastore-datastore-basic-query-python
+        try:
+            filters.apply(query, constants.boats, request.args, owner)
+        except filters.FilterError as error:
+            error_message = {
+                "Error": error.error
+            }
+            return error_message, 400
 
-        # Get the total
+        # The total counts the same filters, keys only
         count_query = client.query(kind=constants.boats)
-        count_results = len(list(count_query.fetch()))
-
-        # Pagination token condition
-        if boat_iterator.next_page_token:
-            next_offset = query_offset + query_limit
-            next_url = request.base_url + "?limit=" + str(query_limit) + "&offset=" + str(next_offset)
-        else:
-            next_url = None
-
-        # Create the data per the pages
-        for entry in results:
-            entry["id"] = entry.key.id
-            entry["self"] = request.host_url + "boats/" + str(entry.key.id)
-
-            # Add in the loads self
-            if len(entry["loads"]) > 0:
-                for each_load in entry["loads"]:
-                    each_load["self"] = request.host_url + "loads/" + str(each_load["id"])
-
-        output = {"boats": results}
-
-        if next_url:
-            output["next"] = next_url
-
-        output["total"] = count_results
-
-        return output, 200
-
-    else:   # Patch, Delete, Put
+        filters.apply(count_query, constants.boats, request.args, owner)
+        count_query.keys_only()
+
+        # Pages are cached per owner (or public), the builder only runs on a miss or a stale page
+        args = request.args.to_dict()
+        output, etag = await listing_cache.fetch(
+            constants.boats, owner, args, request.host_url,
+            functools.partial(list_boats, query, args, request.base_url, request.host_url, count_query)
+        )
+
+        return output, 200, {'ETag': etag}
+
+
+@bp.route('/search', methods=['GET', 'POST', 'PATCH', 'DELETE', 'PUT'])
+@gate.guard(['GET'], optional_login=['GET'])
+async def boats_search():
+    """ Boats with every word of q as the start of a word of their name.
+        Served by one indexed query on the search tokens. Scoped to the owner when logged in.
+    """
+    payload = g.jwt_payload
+    owner = payload["sub"] if payload else None
+
+    query = search.build_query(constants.boats, request.args.get('q', ''), owner)
+    if query is None:
         error_message = {
-            "Error": "Method not allowed"
+            "Error": "q must contain at least one letter or digit"
         }
-        return error_message, 405
+        return error_message, 400
+
+    # The total counts the matches, keys only
+    count_query = search.build_query(constants.boats, request.args.get('q', ''), owner)
+    count_query.keys_only()
+    output = await list_boats(query, request.args.to_dict(), request.base_url, request.host_url, count_query)
+    return output, 200
 
 
 @bp.route('/<boat_id>', methods=['GET', 'DELETE', 'PATCH', 'PUT', 'POST'])
-def boats_specific(boat_id):
+@gate.guard(['GET', 'DELETE', 'PATCH', 'PUT'], login=['GET', 'DELETE', 'PATCH', 'PUT'])
+async def boats_specific(boat_id):
     """ Boat id get and delete route. """
-    # All GET, DELETE, PATCH, PUT methods are protected
-    try:
-        payload = auth.verify_jwt(request)
-    except:
-        return auth.verify_jwt(request)
-
+    # All GET, DELETE, PATCH, PUT methods are protected - the token was verified by the gate
+    payload = g.jwt_payload
     boat_key = client.key(constants.boats, int(boat_id))
-    boat = client.get(key=boat_key)
+    boat = await pool.run(client.get, key=boat_key)
 
     # If no boat is found per the key
     if boat is None:
@@ -168,39 +240,25 @@ def boats_specific(boat_id):
         }
         return error_message, 403
 
-    # Check accept header for json
-    if 'application/json' not in request.accept_mimetypes:
-        error_message = {
-            "Error": "Client must accept valid JSON"
-        }
-        return error_message, 406
-
     # Begin all REST methods
     if request.method == "GET":
+        search_tokens.hide(boat)
         # Generating self on the fly
         boat["id"] = boat.key.id
         boat["self"] = request.base_url
 
-        if len(boat["loads"]) > 0:
-            for each_load in boat["loads"]:
-                # Generating self on the fly
-                each_load["self"] = request.host_url + "loads/" + str(each_load["id"])
+        # Assemble the loads from the carrier references
+        boat["loads"] = carriers.loads_for_boat(boat.key.id, request.host_url)
 
         return boat, 200
 
     elif request.method == 'DELETE':
-        # Fix the load if deleting
-        load_query = client.query(kind=constants.load)
-        loads_results = list(load_query.fetch())
-
-        # Set all load carriers to None
-        for each_load in loads_results:
-            if each_load["carrier"] is not None:
-                if each_load["carrier"]["id"] == int(boat_id):
-                    each_load["carrier"] = None
-                    client.put(each_load)
-
-        client.delete(boat_key)
+        # Commit the delete with a tombstone, the carried loads are unloaded in the background once committed
+        unit = unit_of_work.current(transactional=True)
+        unit.put(tombstones.create(constants.boats, boat.key.id, boat["owner"]))
+        unit.delete(boat_key)
+        unit.on_commit(lambda: carriers.unload_deleted_boat(boat.key.id))
+        unit.on_commit(lambda: listing_cache.invalidate(boat["owner"]))
         return '', 204
 
     elif request.method == 'PATCH':
@@ -255,15 +313,21 @@ def boats_specific(boat_id):
 
         # Update boat
         boat.update(boat_data)
-        client.put(boat)
+        search_tokens.index(boat, constants.boats)
+        # The aggregates may have changed since the boat was read, the stored ones are kept
+        unit = unit_of_work.current()
+        unit.put(boat, keep=aggregate_fields.FIELDS)
+        unit.on_commit(lambda: listing_cache.invalidate(boat["owner"]))
 
         # Add in other details to boat
+        search_tokens.hide(boat)
         boat["id"] = boat.key.id
+        boat["loads"] = carriers.loads_for_boat(boat.key.id, request.host_url)
         # Generating self on the fly - self is never stored
         boat["self"] = request.base_url
         return boat, 200
 
-    elif request.method == 'PUT':
+    else:   # Put
         # All
         # In the event that all headers indicate JSON but the content is not formatted as JSON.
         try:
@@ -309,43 +373,35 @@ def boats_specific(boat_id):
 
         # Update boat
         boat.update(boat_data)
-        client.put(boat)
+        search_tokens.index(boat, constants.boats)
+        # The aggregates may have changed since the boat was read, the stored ones are kept
+        unit = unit_of_work.current()
+        unit.put(boat, keep=aggregate_fields.FIELDS)
+        unit.on_commit(lambda: listing_cache.invalidate(boat["owner"]))
 
         # Add in other details to boat
+        search_tokens.hide(boat)
         boat["id"] = boat.key.id
+        boat["loads"] = carriers.loads_for_boat(boat.key.id, request.host_url)
         # Generating self on the fly - self is never stored
         boat["self"] = request.base_url
 
         return boat, 200
 
-    else:   # Post
-        error_message = {
-            "Error": "Method not allowed"
-        }
-        return error_message, 405
-
 
 @bp.route('/<boat_id>/loads/<load_id>', methods=['PUT', 'DELETE', 'GET', 'POST', 'PATCH'])
-def add_delete_load(boat_id, load_id):
+@gate.guard(['PUT', 'DELETE'], login=['PUT', 'DELETE'])
+async def add_delete_load(boat_id, load_id):
     """ Boat id add and delete load route."""
-    # For both methods, all details are verified
-    try:
-        payload = auth.verify_jwt(request)
-    except:
-        return auth.verify_jwt(request)
-
+    # For both methods, all details are verified - the token by the gate
+    #   The boat and load are independent so they are fetched concurrently
+    payload = g.jwt_payload
     boat_key = client.key(constants.boats, int(boat_id))
-    boat = client.get(key=boat_key)
     load_key = client.key(constants.load, int(load_id))
-    load = client.get(key=load_key)
-
-    # Only the boat owner can edit their own boats
-    #   Boat owner can add any load
-    if boat["owner"] != payload["sub"]:
-        error_message = {
-            "Error": "This boat does not belong to you"
-        }
-        return error_message, 403
+    boat, load = await asyncio.gather(
+        pool.run(client.get, key=boat_key),
+        pool.run(client.get, key=load_key)
+    )
 
     # If no load or boat are found per the key
     if boat is None or load is None:
@@ -354,77 +410,56 @@ def add_delete_load(boat_id, load_id):
         }
         return error_message, 404
 
-    # Check accept header for json
-    if 'application/json' not in request.accept_mimetypes:
+    # Only the boat owner can edit their own boats
+    #   Boat owner can add any load
+    if boat["owner"] != payload["sub"]:
         error_message = {
-            "Error": "Client must accept valid JSON"
+            "Error": "This boat does not belong to you"
         }
-        return error_message, 406
+        return error_message, 403
 
     # Begin boat loading/unloading changes
     if request.method == 'PUT':
-        # If the boat already has a carrier
+        # If the boat already has a carrier - a deleted carrier counts as none
+        read = aggregates.read_load(load)
+        tombstones.hide_dead_carriers([load])
         if load["carrier"] is not None:
             error_message = {
                 "Error": "The load is already loaded on another boat"
             }
             return error_message, 403
 
-        # Add the load details
-        add_load_data = {
-            "id": load.id
-        }
-
-        # Stack on the loads
-        if len(boat["loads"]) != 0:
-            boat["loads"].append(add_load_data)
-        else:
-            boat["loads"] = [add_load_data]
-
-        # Change the carrier
+        # Change the carrier - the boat is not rewritten, its loads are queried by carrier
         new_load_carrier = {
             "id": int(boat_id)
         }
 
         load["carrier"] = new_load_carrier
 
-        client.put(load)
-        client.put(boat)  # Boat was updated directly via their keys
+        # A concurrent request may have loaded or changed the load since it was read
+        unit = unit_of_work.current()
+        unit.put(load)
+        unit.expect(load_key, read)
+        aggregates.adjust(unit, boat_id, 1, load["volume"])
+        unit.on_commit(lambda: listing_cache.invalidate(boat["owner"], load["owner"]))
         return '', 204
 
-    elif request.method == 'DELETE':
-        # This boat is not actually loaded with anything
-        if len(boat["loads"]) == 0:
-            error_message = {
-                "Error": "No boat with this boat_id is loaded with the load with this load_id"
-            }
-            return error_message, 404
-
-        # Because one load can be on a boat at a time, remove based on the singular index
-        removal_idx = None
-        for each_load in range(len(boat["loads"])):
-            if boat["loads"][each_load]["id"] == int(load_id):
-                removal_idx = each_load
-
-        # Pop from the list if there is a matching load id
-        if removal_idx is not None:
-            boat["loads"].pop(removal_idx)
-        else:
+    else:   # Delete
+        # This load is not actually loaded on this boat
+        if load["carrier"] is None or load["carrier"]["id"] != int(boat_id):
             error_message = {
                 "Error": "No boat with this boat_id is loaded with the load with this load_id"
             }
             return error_message, 404
 
         # Remove the carrier
+        read = aggregates.read_load(load)
         load["carrier"] = None
 
-        client.put(load)
-        client.put(boat)
+        unit = unit_of_work.current()
+        unit.put(load)
+        unit.expect(load_key, read)
+        aggregates.adjust(unit, boat_id, -1, -load["volume"])
+        unit.on_commit(lambda: listing_cache.invalidate(boat["owner"], load["owner"]))
 
         return '', 204
-
-    else:   # Get, Post, Patch
-        error_message = {
-            "Error": "Method not allowed"
-        }
-        return error_message, 405
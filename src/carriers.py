@@ -0,0 +1,76 @@
+from google.cloud import datastore
+from src import constants
+from src import listing_cache
+from src import sequence
+from src import tasks
+from src import tombstones
+
+client = datastore.Client()
+
+# Loads unloaded per put_multi by the delete cascade
+CASCADE_BATCH = 500
+
+
+def carried_query(boat_id, keys_only=False):
+    """ Query for the loads carried by a boat.
+        The relationship is stored as the indexed carrier reference on each load.
+    """
+    query = client.query(kind=constants.load)
+    query.add_filter("carrier.id", "=", int(boat_id))
+    if keys_only:
+        query.keys_only()
+    return query
+
+
+def loads_for_boat(boat_id, host_url):
+    """ Assemble the loads list of a boat in the same shape it was stored in."""
+    loads = []
+    for each_load in carried_query(boat_id, keys_only=True).fetch():
+        loads.append({
+            "id": each_load.key.id,
+            "self": host_url + "loads/" + str(each_load.key.id)
+        })
+    return loads
+
+
+@tasks.handler("clear_carrier")
+def clear_carrier(payload):
+    """ Unload every load carried by a deleted boat.
+        Safe to retry - loads that were already cleared no longer match the query.
+        Each batch is re-read in a transaction and only loads still on the deleted boat are cleared, so a
+        load moved to another boat (the tombstone already shows it as unassigned) or edited meanwhile is kept.
+        Does nothing unless the boat has a pending cascade, so a stray task can not empty a live boat.
+    """
+    boat_id = payload["boat_id"]
+    tombstone = client.get(tombstones.tombstone_key(constants.boats, boat_id))
+    if tombstone is None or not tombstone["cascade_pending"]:
+        return
+
+    while True:
+        load_keys = [each_load.key for each_load in carried_query(boat_id, keys_only=True).fetch(limit=CASCADE_BATCH)]
+        if not load_keys:
+            break
+
+        with client.transaction():
+            loads_results = [
+                each_load for each_load in client.get_multi(load_keys)
+                if each_load["carrier"] is not None and each_load["carrier"]["id"] == int(boat_id)
+            ]
+            for each_load in loads_results:
+                each_load["carrier"] = None
+            sequence.stamp(*loads_results)
+            client.put_multi(loads_results)
+        listing_cache.invalidate(*(each_load["owner"] for each_load in loads_results))
+        tasks.progress("clear_carrier", len(loads_results))
+
+    tombstones.finish(constants.boats, boat_id)
+
+
+def unload_deleted_boat(boat_id):
+    tasks.enqueue("clear_carrier", {"boat_id": int(boat_id)}, task_id="clear_carrier-" + str(boat_id))
+
+
+def resume_pending():
+    """ Queue the cascades of boats deleted on instances that stopped before finishing them."""
+    for tombstone in tombstones.pending(constants.boats):
+        unload_deleted_boat(tombstone["entity_id"])
@@ -0,0 +1,161 @@
+""" Delta sync change feed.
+    GET /changes?since=<token> returns the owner's boats and loads created, updated or deleted after the
+    token, oldest first, from indexed (owner, updated_at) queries on the boats, loads and tombstones.
+    Every response carries the token for the next call. Changes newer than SETTLE are held back until
+    writes stamped before them have had time to commit, so a client never skips past a late commit.
+"""
+import asyncio
+import base64
+import binascii
+from urllib.parse import urlencode
+
+from flask import Blueprint, g, request
+from google.cloud import datastore
+from src import constants
+from src import gate
+from src import pool
+from src import search_tokens
+from src import sequence
+from src import tombstones
+
+client = datastore.Client()
+bp = Blueprint('changes', __name__, url_prefix='/changes')
+
+# Microseconds a change is held back before it is served
+SETTLE = 5 * 1000000
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+# How each kind is named in the feed and in its URLs
+NAMES = {
+    constants.boats: "boats",
+    constants.load: "loads"
+}
+
+
+def encode_token(cursor):
+    """ Opaque token for a (updated_at, kind, id) position in the feed."""
+    updated_at, kind, entity_id = cursor
+    return base64.urlsafe_b64encode((str(updated_at) + ":" + kind + ":" + str(entity_id)).encode()).decode()
+
+
+def decode_token(token):
+    """ Returns None for a token that was not produced by encode_token."""
+    try:
+        updated_at, position = base64.urlsafe_b64decode(token.encode()).decode().split(":", 1)
+        kind, entity_id = position.rsplit(":", 1)
+        return int(updated_at), kind, int(entity_id)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
+
+
+def fetch_kind(kind, owner, since, horizon, limit):
+    """ Up to limit entities of a kind changed from since (inclusive, ties are skipped later) to horizon."""
+    query = client.query(kind=kind)
+    query.add_filter("owner", "=", owner)
+    query.add_filter(sequence.FIELD, ">=", since)
+    query.add_filter(sequence.FIELD, "<=", horizon)
+    query.order = [sequence.FIELD]
+    return list(query.fetch(limit=limit))
+
+
+def position(kind, entity):
+    """ Place of an entity in the feed, ties on updated_at are broken by kind and id."""
+    if kind == constants.tombstones:
+        return entity[sequence.FIELD], kind + "." + entity["entity_kind"], entity["entity_id"]
+    return entity[sequence.FIELD], kind, entity.key.id
+
+
+def describe(kind, entity, host_url):
+    """ The change entry of a stored boat, load or tombstone."""
+    if kind == constants.tombstones:
+        return {
+            "kind": NAMES[entity["entity_kind"]],
+            "id": entity["entity_id"],
+            "updated_at": entity[sequence.FIELD],
+            "deleted": True
+        }
+
+    search_tokens.hide(entity)
+    entity["id"] = entity.key.id
+    entity["self"] = host_url + NAMES[kind] + "/" + str(entity.key.id)
+    if kind == constants.load and entity["carrier"] is not None:
+        entity["carrier"]["self"] = host_url + "boats/" + str(entity["carrier"]["id"])
+    return {
+        "kind": NAMES[kind],
+        "id": entity.key.id,
+        "updated_at": entity[sequence.FIELD],
+        "deleted": False,
+        "data": entity
+    }
+
+
+@bp.route('', methods=['GET', 'POST', 'PATCH', 'DELETE', 'PUT'])
+@gate.guard(['GET'], login=['GET'])
+async def changes_since():
+    """ Changes to the owner's boats and loads after the since token, paginated by the returned token."""
+    payload = g.jwt_payload
+
+    # No token is a full sync from the start
+    cursor = (0, "", 0)
+    if 'since' in request.args:
+        cursor = decode_token(request.args['since'])
+        if cursor is None:
+            error_message = {
+                "Error": "since must be a token returned by this endpoint"
+            }
+            return error_message, 400
+
+    try:
+        limit = min(int(request.args.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        error_message = {
+            "Error": "limit must be a positive integer"
+        }
+        return error_message, 400
+
+    horizon = sequence.next_value() - SETTLE
+    kinds = (constants.boats, constants.load, constants.tombstones)
+    kind_results = await asyncio.gather(
+        *(pool.run(fetch_kind, kind, payload["sub"], cursor[0], horizon, limit + 1) for kind in kinds)
+    )
+
+    # Merge the kinds in feed order, skipping what the token has already covered
+    entries = []
+    for kind, results in zip(kinds, kind_results):
+        for entity in results:
+            entity_position = position(kind, entity)
+            if entity_position > cursor:
+                entries.append((entity_position, kind, entity))
+    entries.sort(key=lambda entry: entry[0])
+
+    # A kind that filled its query has unread changes, nothing after its last fetched change can be served yet
+    more = len(entries) > limit
+    for kind, results in zip(kinds, kind_results):
+        if len(results) > limit:
+            more = True
+            bound = position(kind, results[-1])
+            entries = [entry for entry in entries if entry[0] <= bound]
+    entries = entries[:limit]
+
+    # Loads on deleted boats are unassigned even if the cascade has not reached them yet
+    await pool.run(tombstones.hide_dead_carriers, [entity for _, kind, entity in entries if kind == constants.load])
+
+    if entries:
+        next_cursor = entries[-1][0]
+    else:
+        # Nothing changed up to the horizon, later polls can start there
+        next_cursor = max(cursor, (horizon, "", 0))
+
+    output = {
+        "changes": [describe(kind, entity, request.host_url) for _, kind, entity in entries],
+        "since": encode_token(next_cursor)
+    }
+
+    if more:
+        output["next"] = request.base_url + "?" + urlencode({"since": output["since"], "limit": limit})
+
+    return output, 200
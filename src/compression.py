@@ -0,0 +1,112 @@
+""" Response compression negotiated from Accept-Encoding.
+    JSON listings repeat the same keys and self URLs, so they shrink several times over.
+    Brotli is used when the brotli package is installed and the client prefers it, gzip otherwise.
+"""
+import collections
+import threading
+import zlib
+
+from flask import Blueprint, current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+bp = Blueprint('compression', __name__)
+
+# Defaults, overridable through app.config
+MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+COMPRESSIBLE = ('application/json', 'text/html', 'text/plain')
+
+# Compressed bodies of responses with an ETag, keyed by (etag, encoding)
+CACHE_SIZE = 256
+CACHE_MAX_BODY = 1024 * 1024
+cache = collections.OrderedDict()
+cache_lock = threading.Lock()
+
+
+def choose_encoding():
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+def compressor(encoding):
+    """ Return (compress chunk, finish) functions for a streaming compressor."""
+    if encoding == 'br':
+        stream = brotli.Compressor(quality=current_app.config.get('COMPRESS_BROTLI_QUALITY', BROTLI_QUALITY))
+        return (lambda chunk: stream.process(chunk) + stream.flush()), stream.finish
+
+    # wbits 31 writes the gzip header and trailer
+    stream = zlib.compressobj(current_app.config.get('COMPRESS_GZIP_LEVEL', GZIP_LEVEL), zlib.DEFLATED, 31)
+    return (lambda chunk: stream.compress(chunk) + stream.flush(zlib.Z_SYNC_FLUSH)), stream.flush
+
+
+def compress(data, encoding):
+    process, finish = compressor(encoding)
+    return process(data) + finish()
+
+
+def compress_stream(chunks, process, finish):
+    """ Compress a generator response chunk by chunk, flushing each so streaming is kept."""
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        compressed = process(chunk)
+        if compressed:
+            yield compressed
+    yield finish()
+
+
+def cached_compress(data, encoding, etag):
+    if etag is None or len(data) > CACHE_MAX_BODY:
+        return compress(data, encoding)
+
+    cache_key = (etag, encoding)
+    with cache_lock:
+        if cache_key in cache:
+            cache.move_to_end(cache_key)
+            return cache[cache_key]
+
+    compressed = compress(data, encoding)
+    with cache_lock:
+        cache[cache_key] = compressed
+        if len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+    return compressed
+
+
+@bp.after_app_request
+def compress_response(response):
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        process, finish = compressor(encoding)
+        response.response = compress_stream(response.response, process, finish)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config.get('COMPRESS_MIN_SIZE', MIN_SIZE):
+            return response
+
+        etag, weak = response.get_etag()
+        response.set_data(cached_compress(data, encoding, etag))
+
+        # Each encoding is a different representation, so it needs its own ETag
+        if etag is not None:
+            response.set_etag(etag + '-' + encoding, weak=weak)
+
+    response.headers['Content-Encoding'] = encoding
+    return response
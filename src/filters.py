@@ -0,0 +1,172 @@
+from src import constants
+
+# Query string parameters that are handled by the listing routes themselves
+RESERVED = ("limit", "offset", "sort")
+
+# Range operators accepted as field[op]=value
+RANGE_OPS = {
+    "gt": ">",
+    "gte": ">=",
+    "lt": "<",
+    "lte": "<="
+}
+
+# Filterable attributes per kind and how their query string values are parsed
+FIELDS = {
+    constants.boats: {
+        "name": str,
+        "type": str,
+        "length": int,
+        "owner": str,
+        "load_count": int,
+        "total_volume": int
+    },
+    constants.load: {
+        "volume": int,
+        "item": str,
+        "creation_date": str,
+        "carrier": "carrier",
+        "owner": str
+    }
+}
+
+# Attributes that can be range filtered or sorted on
+ORDERABLE = {
+    constants.boats: ("name", "type", "length", "load_count", "total_volume"),
+    constants.load: ("volume", "creation_date", "item")
+}
+
+# Equality prefixes that have composite indexes in index.yaml.
+#   Every prefix is indexed against each orderable attribute in both directions.
+#   Keep this in sync with index.yaml.
+INDEXED_PREFIXES = {
+    constants.boats: (
+        ("owner",),
+        ("type",),
+        ("owner", "type")
+    ),
+    constants.load: (
+        ("owner",),
+        ("item",),
+        ("carrier",),
+        ("carrier.id",),
+        ("owner", "carrier"),
+        ("owner", "carrier.id")
+    )
+}
+
+
+class FilterError(Exception):
+    def __init__(self, error):
+        self.error = error
+
+
+def _parse_value(kind, field, raw):
+    """ Convert the query string value into the stored type and the datastore property name."""
+    parser = FIELDS[kind][field]
+
+    # Carrier is either unassigned (none) or a boat id stored in the embedded carrier entity
+    if parser == "carrier":
+        if raw.lower() == "none":
+            return "carrier", None
+        try:
+            return "carrier.id", int(raw)
+        except ValueError:
+            raise FilterError("carrier must be a boat id or none")
+
+    try:
+        return field, parser(raw)
+    except ValueError:
+        raise FilterError(field + " must be a valid " + parser.__name__)
+
+
+def _check_index(kind, equalities, order_field):
+    """ Fail fast on combinations datastore can not serve from the shipped indexes."""
+    # Equality only queries are served by the built-in indexes (merge join)
+    if order_field is None:
+        return
+
+    # A single property ordering or range is served by the built-in indexes
+    if not equalities:
+        return
+
+    if order_field in equalities:
+        raise FilterError("Can not filter for equality and order on " + order_field)
+
+    prefix = tuple(sorted(equalities))
+    for each_prefix in INDEXED_PREFIXES[kind]:
+        if tuple(sorted(each_prefix)) == prefix:
+            return
+
+    raise FilterError("Unsupported filter combination: " + ", ".join(prefix) + " with " + order_field)
+
+
+def apply(query, kind, args, owner=None):
+    """ Add the equality, range and sort query string parameters to the datastore query.
+        Supported forms are field=value, field[gt|gte|lt|lte]=value and sort=field or sort=-field.
+        Raises FilterError when the parameters can not be served by an index.
+    """
+    equalities = {}
+    ranges = []
+
+    if owner is not None:
+        equalities["owner"] = owner
+
+    for each_arg in args:
+        if each_arg in RESERVED:
+            continue
+
+        # Split field[op] into the field and the operator
+        field, op = each_arg, "="
+        if each_arg.endswith("]") and "[" in each_arg:
+            field, op = each_arg[:-1].split("[", 1)
+            if op not in RANGE_OPS:
+                raise FilterError("Unsupported operator: " + op)
+            op = RANGE_OPS[op]
+
+        if field not in FIELDS[kind]:
+            raise FilterError("Unsupported filter: " + field)
+
+        # Owner of an authenticated listing is always the token subject
+        if field == "owner" and owner is not None:
+            raise FilterError("owner can not be filtered on an authenticated listing")
+
+        if op == "=":
+            prop, value = _parse_value(kind, field, args[each_arg])
+            if prop in equalities:
+                raise FilterError("Duplicate filter: " + field)
+            equalities[prop] = value
+        else:
+            if field not in ORDERABLE[kind]:
+                raise FilterError("Range filters are not supported on " + field)
+            prop, value = _parse_value(kind, field, args[each_arg])
+            ranges.append((prop, op, value))
+
+    # Datastore allows inequality filters on a single property only
+    range_fields = set(each_range[0] for each_range in ranges)
+    if len(range_fields) > 1:
+        raise FilterError("Range filters are only supported on one attribute at a time")
+    range_field = range_fields.pop() if range_fields else None
+
+    sort = args.get("sort")
+    sort_field = None
+    if sort:
+        sort_field = sort[1:] if sort.startswith("-") else sort
+        if sort_field not in ORDERABLE[kind]:
+            raise FilterError("Unsupported sort: " + sort_field)
+
+        # The first sort order must be the range filtered property
+        if range_field is not None and sort_field != range_field:
+            raise FilterError("sort must be on the range filtered attribute " + range_field)
+
+    order_field = range_field or sort_field
+    _check_index(kind, equalities, order_field)
+
+    for prop, value in equalities.items():
+        query.add_filter(prop, "=", value)
+    for prop, op, value in ranges:
+        query.add_filter(prop, op, value)
+    if sort:
+        query.order = [sort]
+
+    return query
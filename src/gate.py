@@ -0,0 +1,68 @@
+""" Declarative request checks for the API routes.
+    guard runs the cheap checks of a route in cost order before any handler code: the method (405),
+    the Accept header (406) and then the JWT, verified once (401). Bad methods and content negotiation
+    never cost a JWKS lookup or a datastore read.
+    The verified payload is stored in g.jwt_payload - None when the login is optional and missing.
+"""
+import functools
+import inspect
+
+from flask import g, request
+from src import auth
+from src import pool
+
+
+def reject(methods, json):
+    """ Response for a request that fails the method or Accept checks, None if it passes them."""
+    if request.method not in methods:
+        error_message = {
+            "Error": "Method not allowed"
+        }
+        return error_message, 405
+
+    # Check accept header for json
+    if json and 'application/json' not in request.accept_mimetypes:
+        error_message = {
+            "Error": "Client must accept valid JSON"
+        }
+        return error_message, 406
+
+    return None
+
+
+def verifier(login, optional_login):
+    """ The JWT check of the request method, None for methods open to anyone."""
+    if request.method in login:
+        return auth.verify_jwt
+    if request.method in optional_login:
+        return auth.verify_jwt_optional
+    return None
+
+
+def guard(methods, login=(), optional_login=(), json=True):
+    """ Decorate a sync or async view with its checks, below the route decorator.
+        Routes keep registering every method so a disallowed one gets the JSON 405 instead of Flask's page.
+        e.g. @guard(['GET', 'POST'], login=['POST'], optional_login=['GET'])
+    """
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def gated(*args, **kwargs):
+                rejected = reject(methods, json)
+                if rejected is not None:
+                    return rejected
+                verify = verifier(login, optional_login)
+                g.jwt_payload = await pool.run(verify, request) if verify else None
+                return await view(*args, **kwargs)
+        else:
+            @functools.wraps(view)
+            def gated(*args, **kwargs):
+                rejected = reject(methods, json)
+                if rejected is not None:
+                    return rejected
+                verify = verifier(login, optional_login)
+                g.jwt_payload = verify(request) if verify else None
+                return view(*args, **kwargs)
+
+        return gated
+    return decorator
@@ -0,0 +1,81 @@
+""" Idempotency-Key support for the POST routes.
+    The response of a create is stored in its own kind, written in the same transaction as the new
+    entity. A retry with the same key gets the stored response back instead of creating a duplicate.
+    Records expire after TTL - a datastore TTL policy on the expires property can delete them.
+"""
+import datetime
+import hashlib
+import json
+
+from google.api_core import exceptions
+from google.cloud import datastore
+from src import constants
+
+client = datastore.Client()
+
+TTL = datetime.timedelta(hours=24)
+
+
+def record_key(owner, route, idempotency_key):
+    """ Keys are scoped per owner and route so clients can not collide with each other."""
+    return client.key(constants.idempotency, owner + ":" + route + ":" + idempotency_key)
+
+
+def request_hash(content):
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def live(record):
+    return record is not None and record["expires"] > datetime.datetime.now(datetime.timezone.utc)
+
+
+def stored_response(record, content):
+    if record["request_hash"] != request_hash(content):
+        error_message = {
+            "Error": "This Idempotency-Key was already used with a different request"
+        }
+        return error_message, 422
+    return json.loads(record["body"]), record["status"], {'Idempotent-Replayed': 'true'}
+
+
+def replay(owner, route, idempotency_key, content):
+    """ Return the stored response for a retried request, or None if the key is new."""
+    record = client.get(record_key(owner, route, idempotency_key))
+    if live(record):
+        return stored_response(record, content)
+    return None
+
+
+def create(entity, owner, route, idempotency_key, content, respond):
+    """ Write the new entity and its stored response in one transaction.
+        respond(entity_id) builds the (body, status) response once the id has been allocated.
+        If a concurrent request with the same key committed first, its response is returned instead.
+    """
+    entity.key = client.allocate_ids(entity.key, 1)[0]
+    body, status = respond(entity.key.id)
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    record = datastore.entity.Entity(key=record_key(owner, route, idempotency_key), exclude_from_indexes=("body",))
+    record.update({
+        "request_hash": request_hash(content),
+        "status": status,
+        "body": json.dumps(body),
+        "created": now,
+        "expires": now + TTL
+    })
+
+    try:
+        with client.transaction():
+            existing = client.get(record.key)
+            if not live(existing):
+                client.put(entity)
+                client.put(record)
+    except (exceptions.Conflict, exceptions.Aborted):
+        # A concurrent request with the same key committed the record first, reply with its response
+        existing = client.get(record.key)
+        if not live(existing):
+            raise
+
+    if live(existing):
+        return stored_response(existing, content)
+    return body, status
@@ -0,0 +1,114 @@
+""" Per-client rate limiting and load shedding.
+    Runs before every request so rejected clients never reach auth, Auth0 or datastore.
+"""
+import math
+import threading
+import time
+
+from flask import Blueprint, request, g
+from src import auth
+
+bp = Blueprint('limiter', __name__)
+
+# Token bucket budgets per (endpoint, method): (tokens refilled per second, bucket size)
+BUDGETS = {
+    ("boats.boats_all", "POST"): (1.0, 20),
+    ("load.load_all", "POST"): (1.0, 20),
+    ("auth.login_user", "POST"): (0.5, 10),
+    ("auth.refresh_token", "POST"): (1.0, 20),
+    ("auth.register_user", "POST"): (0.1, 5),
+}
+
+# Requests allowed in flight per instance before shedding with a 503
+MAX_CONCURRENT = 64
+
+# Buckets kept in memory before full (idle) buckets are pruned
+MAX_KEYS = 10000
+
+
+class MemoryBackend:
+    """ In-memory token buckets for a single instance.
+        A shared backend only needs to provide the same take(key, rate, burst) method,
+        returning 0 when the request is allowed or the seconds to wait for the next token.
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.pruned = 0
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated, _, _ = self.buckets.get(key, (burst, now, rate, burst))
+            tokens = min(burst, tokens + (now - updated) * rate)
+
+            if tokens < 1:
+                self.buckets[key] = (tokens, now, rate, burst)
+                return (1 - tokens) / rate
+
+            self.buckets[key] = (tokens - 1, now, rate, burst)
+            # Pruning scans every bucket, at most once a second
+            if len(self.buckets) > MAX_KEYS and now - self.pruned > 1:
+                self._prune(now)
+            return 0
+
+    def _prune(self, now):
+        """ Drop the buckets that have refilled to their own burst - they behave the same as a new bucket."""
+        self.pruned = now
+        for key, (tokens, updated, rate, burst) in list(self.buckets.items()):
+            if tokens + (now - updated) * rate >= burst:
+                del self.buckets[key]
+
+
+backend = MemoryBackend()
+in_flight = threading.BoundedSemaphore(MAX_CONCURRENT)
+
+
+def set_backend(new_backend):
+    """ Swap the limiter state to a shared backend (e.g. one backed by memcache or redis)."""
+    global backend
+    backend = new_backend
+
+
+def client_key():
+    """ Key the bucket by the verified token subject, or by the client IP without a valid token.
+        An unverified subject could be forged to get a new bucket on every request. The JWKS is cached and
+        the verified payload is kept for the request, so the route does not verify the token again.
+    """
+    payload = auth.verify_jwt_optional(request)
+    if payload is not None:
+        return "sub:" + payload["sub"]
+
+    # App Engine sets the client IP header and strips any value sent by the client
+    return "ip:" + request.headers.get('X-Appengine-User-Ip', request.remote_addr or "unknown")
+
+
+def too_busy(message, status_code, retry_after):
+    error_message = {
+        "Error": message
+    }
+    return error_message, status_code, {'Retry-After': str(int(math.ceil(retry_after)))}
+
+
+@bp.before_app_request
+def limit_request():
+    """ Shed load before any handler work starts."""
+    if not in_flight.acquire(blocking=False):
+        return too_busy("Server is busy, try again later", 503, 1)
+    g.limiter_slot = True
+
+    budget = BUDGETS.get((request.endpoint, request.method))
+    if budget is None:
+        return None
+
+    rate, burst = budget
+    wait = backend.take(request.endpoint + ":" + client_key(), rate, burst)
+    if wait:
+        return too_busy("Too many requests", 429, wait)
+    return None
+
+
+@bp.teardown_app_request
+def release_slot(exception):
+    if g.pop('limiter_slot', False):
+        in_flight.release()
@@ -0,0 +1,148 @@
+""" Short lived cache of the /boats and /loads listing pages.
+    Pages are keyed by (kind, owner or public, host, query string) and stamped with the generation
+    of the owner they were built for. Every write bumps the generation of the owners it touched and
+    the public generation, so a page built before a write by that owner is never served after it.
+    Pages past their TTL are still served for a short stale window while a fresh copy is built in the background.
+"""
+import asyncio
+import collections
+import threading
+import time
+import uuid
+
+# Seconds a page is fresh, then seconds it may be served stale while it is rebuilt
+TTL = 5
+STALE = 30
+
+PUBLIC = "*"
+
+
+class MemoryBackend:
+    """ Per-instance backend. A shared backend needs the same get, set, get_counter and incr methods. """
+    def __init__(self, max_entries=2000):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        # Generations are never evicted, a reset counter could match an old page
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_counter(self, key):
+        with self.lock:
+            return self.counters.get(key, 0)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+
+backend = MemoryBackend()
+refreshing = set()
+lock = threading.Lock()
+
+metrics = {
+    "hits": 0,
+    "stale_hits": 0,
+    "misses": 0,
+    "refreshes": 0,
+    "refresh_errors": 0
+}
+
+
+def set_backend(new_backend):
+    """ Swap the cache to a shared backend so generations are seen by every instance."""
+    global backend
+    backend = new_backend
+
+
+def count(name):
+    with lock:
+        metrics[name] += 1
+
+
+def get_metrics():
+    with lock:
+        output = dict(metrics)
+    lookups = output["hits"] + output["stale_hits"] + output["misses"]
+    output["hit_rate"] = round((output["hits"] + output["stale_hits"]) / lookups, 3) if lookups else None
+    return output
+
+
+def generation(owner):
+    return backend.get_counter(owner or PUBLIC)
+
+
+def invalidate(*owners):
+    """ Bump the public generation and the generation of every owner touched by a write."""
+    backend.incr(PUBLIC)
+    for owner in set(owners):
+        if owner:
+            backend.incr(owner)
+
+
+def store(key, built_generation, output):
+    etag = '"' + uuid.uuid4().hex + '"'
+    backend.set(key, {
+        "output": output,
+        "etag": etag,
+        "generation": built_generation,
+        "stored": time.monotonic()
+    })
+    return etag
+
+
+def revalidate(key, owner, builder):
+    """ Rebuild a stale page on a background thread, once per key."""
+    with lock:
+        if key in refreshing:
+            return
+        refreshing.add(key)
+
+    def refresh():
+        try:
+            # Read the generation first, a write during the build makes the page a miss
+            built_generation = generation(owner)
+            store(key, built_generation, asyncio.run(builder()))
+            count("refreshes")
+        except Exception:
+            count("refresh_errors")
+        finally:
+            with lock:
+                refreshing.discard(key)
+
+    threading.Thread(target=refresh, name="listing-refresh", daemon=True).start()
+
+
+async def fetch(kind, owner, args, host_url, builder):
+    """ Return (page, etag) for the listing, building it with the async builder on a miss."""
+    key = (kind, owner or PUBLIC, host_url, tuple(sorted(args.items())))
+    current_generation = generation(owner)
+
+    entry = backend.get(key)
+    if entry is not None and entry["generation"] == current_generation:
+        age = time.monotonic() - entry["stored"]
+        if age <= TTL:
+            count("hits")
+            return entry["output"], entry["etag"]
+        if age <= TTL + STALE:
+            count("stale_hits")
+            revalidate(key, owner, builder)
+            return entry["output"], entry["etag"]
+
+    count("misses")
+    output = await builder()
+    return output, store(key, current_generation, output)
@@ -1,27 +1,85 @@
-from flask import Blueprint, request
+import asyncio
+import functools
+from urllib.parse import urlencode
+
+from flask import Blueprint, g, request
 from google.cloud import datastore
 from src import constants
-from src import auth
+from src import aggregates
+from src import filters
+from src import gate
+from src import idempotency
+from src import listing_cache
+from src import pool
+from src import search
+from src import search_tokens
+from src import sequence
+from src import tombstones
+from src import unit_of_work
 
 client = datastore.Client()
 bp = Blueprint('load', __name__, url_prefix='/loads')
 
 
+async def list_loads(query, args, base_url, host_url, count_query=None):
+    """ Build a page of the loads listing.
+        Does not use the flask request so stale pages can be rebuilt in the background.
+        total counts count_query when one is given.
+    """
+    # Pagination details
+    query_limit = int(args.get('limit', '5'))
+    query_offset = int(args.get('offset', '0'))
+
+    load_iterator = query.fetch(limit=query_limit, offset=query_offset)
+    pages = load_iterator.pages
+
+    # The page and the total are independent, fetch them concurrently
+    if count_query is None:
+        count_query = client.query(kind=constants.load)
+    results, count_results = await asyncio.gather(
+        pool.run(lambda: list(next(pages))),
+        pool.run(lambda: len(list(count_query.fetch())))
+    )
+
+    # Pagination token condition
+    if load_iterator.next_page_token:
+        next_offset = query_offset + query_limit
+        # Keep the filters and sort on the next page
+        next_args = {"limit": query_limit, "offset": next_offset}
+        next_args.update((key, value) for key, value in args.items() if key not in next_args)
+        next_url = base_url + "?" + urlencode(next_args)
+    else:
+        next_url = None
+
+    # Loads on deleted boats are unassigned even if the cascade has not reached them yet
+    await pool.run(tombstones.hide_dead_carriers, results)
+
+    # Create the data per the pages
+    for entry in results:
+        search_tokens.hide(entry)
+        entry["id"] = entry.key.id
+        entry["self"] = host_url + "loads/" + str(entry["id"])
+
+        # Add in the boats self
+        if entry["carrier"] is not None:
+            entry["carrier"]["self"] = host_url + "boats/" + str(entry["carrier"]["id"])
+
+    output = {"loads": results}
+
+    if next_url:
+        output["next"] = next_url
+
+    output["total"] = count_results
+
+    return output
+
+
 @bp.route('', methods=['POST', 'GET', 'PATCH', 'DELETE', 'PUT'])
-def load_all():
+@gate.guard(['GET', 'POST'], login=['POST'], optional_login=['GET'])
+async def load_all():
     """ Loads get and post route. """
-    # Check accept header for json
-    if 'application/json' not in request.accept_mimetypes:
-        error_message = {
-            "Error": "Client must accept valid JSON"
-        }
-        return error_message, 406
-
     if request.method == 'POST':
-        try:
-            payload = auth.verify_jwt(request)
-        except:
-            return auth.verify_jwt(request)
+        payload = g.jwt_payload
 
         # In the event that all headers indicate JSON but the content is not formatted as JSON.
         try:
@@ -32,6 +90,13 @@ def load_all():
             }
             return error_message, 415
 
+        # A retried request gets the response of the original back instead of a duplicate
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key:
+            replayed = idempotency.replay(payload["sub"], "loads", idempotency_key, content)
+            if replayed is not None:
+                return replayed
+
         # If there are any missing attributes from the expected 3
         if len(content) < 3:
             error_message = {
@@ -68,90 +133,94 @@ def load_all():
             }
             return error_message, 400
 
+        # Stamped on the data so the response carries updated_at too
+        sequence.stamp(load_data)
         new_load = datastore.entity.Entity(key=client.key(constants.load))
-
         new_load.update(load_data)
-        client.put(new_load)
+        search_tokens.index(new_load, constants.load)
 
-        # Add in the additional post creation data (ID is None until the put is performed)
-        load_data["id"] = new_load.key.id
-        # Generating self on the fly - self is never stored
-        load_data["self"] = request.base_url + "/" + str(new_load.key.id)
-        return load_data, 201
+        def created(load_id):
+            # Add in the additional post creation data (ID is None until the put is performed)
+            load_data["id"] = load_id
+            # Generating self on the fly - self is never stored
+            load_data["self"] = request.base_url + "/" + str(load_id)
+            return load_data, 201
+
+        if idempotency_key:
+            response = idempotency.create(new_load, payload["sub"], "loads", idempotency_key, content, created)
+        else:
+            client.put(new_load)
+            response = created(new_load.key.id)
+
+        listing_cache.invalidate(payload["sub"])
+        return response
 
     # Get all paginated
-    elif request.method == 'GET':
+    else:   # Get
         # If login valid, show specific owner's boats.
         #   Else, all boats in collection
         query = client.query(kind=constants.load)
-        try:
-            payload = auth.verify_jwt(request)
-
-            # datastore query filtering
-            # https://cloud.google.com/datastore/docs/concepts/queries#datastore-datastore-basic-query-python
-            query.add_filter("owner", "=", payload["sub"])
+        # If the verification jwt failed, then there won't be a filter applied to the query
+        #   In this event, all boats are shown to the user and not the ones owned by the boat owner itself
+        payload = g.jwt_payload
+        owner = payload["sub"] if payload else None
 
-        except:
-            # If the verification jwt failed, then there won't be a filter applied to the query
-            #   In this event, all boats are shown to the user and not the ones owned by the boat owner itself
-            pass    # Therefore, pass
-
-        # Pagination details
-        query_limit = int(request.args.get('limit', '5'))
-        query_offset = int(request.args.get('offset', '0'))
-
-        load_iterator = query.fetch(limit=query_limit, offset=query_offset)
-        pages = load_iterator.pages
-
-        results = list(next(pages))
-
-        # Get the total
-        count_query = client.query(kind=constants.boats)
-        count_results = len(list(count_query.fetch()))
-
-        # Pagination token condition
-        if load_iterator.next_page_token:
-            next_offset = query_offset + query_limit
-            next_url = request.base_url + "?limit=" + str(query_limit) + "&offset=" + str(next_offset)
-        else:
-            next_url = None
-
-        # Create the data per the pages
-        for entry in results:
-            entry["id"] = entry.key.id
-            entry["self"] = request.host_url + "loads/" + str(entry["id"])
+        # datastore query filtering
+        # https://cloud.google.com/datastore/docs/concepts/queries#datastore-datastore-basic-query-python
+        try:
+            filters.apply(query, constants.load, request.args, owner)
+        except filters.FilterError as error:
+            error_message = {
+                "Error": error.error
+            }
+            return error_message, 400
 
-            # Add in the boats self
-            if entry["carrier"] is not None:
-                entry["carrier"]["self"] = request.host_url + "boats/" + str(entry["carrier"]["id"])
+        # The total counts the same filters, keys only
+        count_query = client.query(kind=constants.load)
+        filters.apply(count_query, constants.load, request.args, owner)
+        count_query.keys_only()
 
-        output = {"loads": results}
+        # Pages are cached per owner (or public), the builder only runs on a miss or a stale page
+        args = request.args.to_dict()
+        output, etag = await listing_cache.fetch(
+            constants.load, owner, args, request.host_url,
+            functools.partial(list_loads, query, args, request.base_url, request.host_url, count_query)
+        )
 
-        if next_url:
-            output["next"] = next_url
+        return output, 200, {'ETag': etag}
 
-        output["total"] = count_results
 
-        return output, 200
+@bp.route('/search', methods=['GET', 'POST', 'PATCH', 'DELETE', 'PUT'])
+@gate.guard(['GET'], optional_login=['GET'])
+async def loads_search():
+    """ Loads with every word of q as the start of a word of their item.
+        Served by one indexed query on the search tokens. Scoped to the owner when logged in.
+    """
+    payload = g.jwt_payload
+    owner = payload["sub"] if payload else None
 
-    else:   # Patch, Delete, Put
+    query = search.build_query(constants.load, request.args.get('q', ''), owner)
+    if query is None:
         error_message = {
-            "Error": "Method not allowed"
+            "Error": "q must contain at least one letter or digit"
         }
-        return error_message, 405
+        return error_message, 400
 
+    # The total counts the matches, keys only
+    count_query = search.build_query(constants.load, request.args.get('q', ''), owner)
+    count_query.keys_only()
+    output = await list_loads(query, request.args.to_dict(), request.base_url, request.host_url, count_query)
+    return output, 200
 
-@bp.route('/<load_id>', methods=['GET', 'DELETE', 'PATCH', 'PUT'])
-def load_specific(load_id):
-    """ Loads get and delete route."""
-    # All GET, DELETE, PATCH, PUT methods are protected
-    try:
-        payload = auth.verify_jwt(request)
-    except:
-        return auth.verify_jwt(request)
 
+@bp.route('/<load_id>', methods=['GET', 'DELETE', 'PATCH', 'PUT', 'POST'])
+@gate.guard(['GET', 'DELETE', 'PATCH', 'PUT'], login=['GET', 'DELETE', 'PATCH', 'PUT'])
+async def load_specific(load_id):
+    """ Loads get and delete route."""
+    # All GET, DELETE, PATCH, PUT methods are protected - the token was verified by the gate
+    payload = g.jwt_payload
     load_key = client.key(constants.load, int(load_id))
-    load = client.get(key=load_key)
+    load = await pool.run(client.get, key=load_key)
 
     # If no load is found per the key
     if load is None:
@@ -167,18 +236,13 @@ def load_specific(load_id):
         }
         return error_message, 403
 
-    # Check accept header for json
-    if 'application/json' not in request.accept_mimetypes:
-        error_message = {
-            "Error": "Client must accept valid JSON"
-        }
-        return error_message, 406
-
     # Begin all methods
     if request.method == 'GET':
+        search_tokens.hide(load)
         # Generating self on the fly
         load["id"] = load.key.id
         load["self"] = request.base_url
+        tombstones.hide_dead_carriers([load])
 
         if load["carrier"] is not None:
             # Generating self on the fly
@@ -187,24 +251,15 @@ def load_specific(load_id):
         return load, 200
 
     elif request.method == 'DELETE':
-        # Remove the load from a boat if existing
+        # The boat does not store its loads, deleting the load removes it from its carrier
+        # The tombstone is the delete record read by the change feed
+        unit = unit_of_work.current()
+        unit.put(tombstones.create(constants.load, load.key.id, load["owner"], cascade=False))
+        unit.delete(load_key)
+        unit.expect(load_key, aggregates.read_load(load))
         if load["carrier"] is not None:
-            boat_id = load["carrier"]["id"]
-
-            boat_key = client.key(constants.boats, int(boat_id))
-            boat = client.get(key=boat_key)
-
-            # Because one load can be on a boat at a time, remove based on the singular index
-            removal_idx = None
-            for each_load in range(len(boat["loads"])):
-                if boat["loads"][each_load]["id"] == int(load_id):
-                    removal_idx = each_load
-
-            # by popping it out of the list once found
-            boat["loads"].pop(removal_idx)
-            client.put(boat)
-
-        client.delete(load_key)
+            aggregates.adjust(unit, load["carrier"]["id"], -1, -load["volume"])
+        unit.on_commit(lambda: listing_cache.invalidate(load["owner"]))
         return '', 204
 
     elif request.method == 'PATCH':
@@ -257,9 +312,18 @@ def load_specific(load_id):
             }
             return error_message, 400
 
-        # Update load
+        # Update load, a carried load moves its volume change onto the boat
+        read = aggregates.read_load(load)
+        old_volume = load["volume"]
         load.update(load_data)
-        client.put(load)
+        search_tokens.index(load, constants.load)
+        unit = unit_of_work.current()
+        unit.put(load)
+        unit.expect(load_key, read)
+        if load["carrier"] is not None:
+            aggregates.adjust(unit, load["carrier"]["id"], 0, load["volume"] - old_volume)
+        unit.on_commit(lambda: listing_cache.invalidate(load["owner"]))
+        search_tokens.hide(load)
 
         # Add in the other details of load
         load["id"] = load.key.id
@@ -267,7 +331,7 @@ def load_specific(load_id):
         load["self"] = request.base_url
         return load, 200
 
-    elif request.method == 'PUT':
+    else:   # Put
         # All data update
         # In the event that all headers indicate JSON but the content is not formatted as JSON.
         try:
@@ -312,18 +376,21 @@ def load_specific(load_id):
             }
             return error_message, 400
 
-        # Update load
+        # Update load, a carried load moves its volume change onto the boat
+        read = aggregates.read_load(load)
+        old_volume = load["volume"]
         load.update(load_data)
-        client.put(load)
+        search_tokens.index(load, constants.load)
+        unit = unit_of_work.current()
+        unit.put(load)
+        unit.expect(load_key, read)
+        if load["carrier"] is not None:
+            aggregates.adjust(unit, load["carrier"]["id"], 0, load["volume"] - old_volume)
+        unit.on_commit(lambda: listing_cache.invalidate(load["owner"]))
+        search_tokens.hide(load)
 
         # Add in other details of load
         load["id"] = load.key.id
         # Generating self on the fly - self is never stored
         load["self"] = request.base_url
         return load, 200
-
-    else:   # Post
-        error_message = {
-            "Error": "Method not allowed"
-        }
-        return error_message, 405
@@ -0,0 +1,73 @@
+""" Move the boat to loads relationship out of the embedded boat["loads"] array.
+    Every load listed on a boat gets its carrier reference set and the array is removed from the boat.
+
+    Usage: python -m src.migrate_loads [--dry-run] [--batch 500]
+"""
+import argparse
+
+from google.cloud import datastore
+from src import constants
+from src import sequence
+
+client = datastore.Client()
+
+
+def migrate_boat(boat):
+    """ Return the entities to write for a single boat."""
+    load_ids = [each_load["id"] for each_load in boat.get("loads") or []]
+    load_keys = [client.key(constants.load, int(load_id)) for load_id in load_ids]
+
+    changed = []
+    carried = client.get_multi(load_keys) if load_keys else []
+    for each_load in carried:
+        # Loads deleted with the old code may still be listed on the boat
+        if each_load["carrier"] is None or each_load["carrier"]["id"] != boat.key.id:
+            each_load["carrier"] = {
+                "id": boat.key.id
+            }
+            changed.append(each_load)
+
+    del boat["loads"]
+    boat["load_count"] = len(carried)
+    boat["total_volume"] = sum(each_load["volume"] for each_load in carried)
+    changed.append(boat)
+    sequence.stamp(*changed)
+    return changed
+
+
+def migrate(batch=500, dry_run=False):
+    """ Migrate every boat that still stores a loads array."""
+    query = client.query(kind=constants.boats)
+    pending = []
+    boats_migrated = 0
+    loads_migrated = 0
+
+    for boat in query.fetch():
+        if "loads" not in boat:
+            continue
+
+        changed = migrate_boat(boat)
+        boats_migrated += 1
+        loads_migrated += len(changed) - 1
+        pending.extend(changed)
+
+        # Datastore commits are limited to 500 entities
+        while len(pending) >= batch:
+            if not dry_run:
+                client.put_multi(pending[:batch])
+            pending = pending[batch:]
+
+    if pending and not dry_run:
+        client.put_multi(pending)
+
+    return boats_migrated, loads_migrated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Move boat loads arrays to load carrier references")
+    parser.add_argument("--batch", type=int, default=500, help="entities per put_multi")
+    parser.add_argument("--dry-run", action="store_true", help="report without writing")
+    args = parser.parse_args()
+
+    boats_migrated, loads_migrated = migrate(batch=args.batch, dry_run=args.dry_run)
+    print("Boats migrated: " + str(boats_migrated) + ", loads updated: " + str(loads_migrated))
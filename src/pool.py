@@ -0,0 +1,22 @@
+""" Bounded thread pool for the async views.
+    Datastore and Auth0 clients are blocking, so independent calls are run here concurrently
+    and awaited together - a request then waits for the slowest call instead of the sum of them.
+"""
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared by every request on the instance so outbound calls stay bounded
+POOL_SIZE = 32
+
+executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="io")
+
+
+async def run(fn, *args, **kwargs):
+    """ Run a blocking call on the pool.
+        The context is copied so the call can still use the flask request and g.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, fn, *args, **kwargs))
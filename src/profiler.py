@@ -0,0 +1,186 @@
+""" On-demand sampling profiler and slow request capture.
+    A request is profiled when it carries a valid X-Profile header or is picked by PROFILE_SAMPLE_RATE.
+    The header is "<expiry unix time>:<HMAC-SHA256 of path:expiry keyed with the admin secret>", made with
+    python -m src.profiler /boats [--ttl 600], so an observed header stops working once it expires.
+    A background thread samples the thread stacks and any profiled request slower than the threshold
+    is written in folded stack format, ready for flamegraph.pl or speedscope. Every slow request,
+    profiled or not, is kept in a bounded ring buffer served at GET /admin/slow-requests, and profile
+    files are deleted when their entry leaves the buffer.
+    When profiling is off a request only costs two perf_counter calls.
+"""
+import argparse
+import collections
+import datetime
+import hashlib
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from flask import Blueprint, current_app, g, request
+from src import constants
+
+bp = Blueprint('profiler', __name__)
+
+# Defaults, overridable through app.config
+SAMPLE_RATE = 0.0
+SLOW_THRESHOLD_MS = 1000
+INTERVAL = 0.005
+PROFILE_DIR = '/tmp/profiles'
+
+# Slow requests kept for the admin endpoint, and stacks kept per request in memory
+RING_SIZE = 50
+TOP_STACKS = 50
+
+# Seconds an X-Profile header made by the command line stays valid
+HEADER_TTL = 600
+
+slow_requests = collections.deque(maxlen=RING_SIZE)
+slow_requests_lock = threading.Lock()
+
+
+class Sampler:
+    """ Samples every thread's stack at a fixed interval into folded stack counts."""
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own_ident = threading.get_ident()
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for each_thread in threading.enumerate():
+                names[each_thread.ident] = each_thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(frame.f_lineno) + ")")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def folded(self):
+        return "\n".join(stack + " " + str(count) for stack, count in self.stacks.most_common()) + "\n"
+
+
+def signature(path, expires):
+    message = path + ":" + str(expires)
+    return hmac.new(constants.admin_secret.encode(), message.encode(), hashlib.sha256).hexdigest()
+
+
+def header_value(path, ttl=HEADER_TTL):
+    expires = int(time.time()) + ttl
+    return str(expires) + ":" + signature(path, expires)
+
+
+def valid_header(header):
+    expires, _, given = header.partition(':')
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(given, signature(request.path, int(expires)))
+
+
+def should_profile():
+    header = request.headers.get('X-Profile')
+    if header and constants.admin_secret:
+        return valid_header(header)
+    rate = current_app.config.get('PROFILE_SAMPLE_RATE', SAMPLE_RATE)
+    return rate > 0 and random.random() < rate
+
+
+@bp.before_app_request
+def start_request():
+    g.profile_start = time.perf_counter()
+    if should_profile():
+        g.profile_sampler = Sampler(current_app.config.get('PROFILE_INTERVAL', INTERVAL))
+        g.profile_sampler.start()
+
+
+@bp.after_app_request
+def record_status(response):
+    g.profile_status = response.status_code
+    return response
+
+
+@bp.teardown_app_request
+def finish_request(exception):
+    start = g.pop('profile_start', None)
+    if start is None:
+        return
+    duration_ms = (time.perf_counter() - start) * 1000
+
+    sampler = g.pop('profile_sampler', None)
+    if sampler is not None:
+        sampler.stop()
+
+    if duration_ms < current_app.config.get('PROFILE_SLOW_MS', SLOW_THRESHOLD_MS):
+        return
+
+    entry = {
+        "method": request.method,
+        "path": request.full_path.rstrip('?'),
+        "status": g.pop('profile_status', 500),
+        "duration_ms": round(duration_ms, 1),
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat()
+    }
+
+    if sampler is not None:
+        entry["stacks"] = [stack + " " + str(count) for stack, count in sampler.stacks.most_common(TOP_STACKS)]
+        entry["profile"] = write_profile(sampler, entry)
+
+    with slow_requests_lock:
+        # The oldest entry is evicted by the append, its profile goes with it
+        if len(slow_requests) == RING_SIZE:
+            delete_profile(slow_requests[0].get("profile"))
+        slow_requests.append(entry)
+
+
+def write_profile(sampler, entry):
+    """ Write the folded stacks to the profile directory and return the file name."""
+    profile_dir = current_app.config.get('PROFILE_DIR', PROFILE_DIR)
+    name = (entry["time"].replace(':', '-') + "-" + entry["method"] + "-"
+            + re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_') + ".folded")
+    try:
+        os.makedirs(profile_dir, exist_ok=True)
+        with open(os.path.join(profile_dir, name), 'w') as profile:
+            profile.write(sampler.folded())
+    except OSError:
+        return None
+    return name
+
+
+def delete_profile(name):
+    if name is None:
+        return
+    try:
+        os.remove(os.path.join(current_app.config.get('PROFILE_DIR', PROFILE_DIR), name))
+    except OSError:
+        pass
+
+
+def recent():
+    return list(slow_requests)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Make an X-Profile header value for a request path")
+    parser.add_argument("path", help="request path, e.g. /boats")
+    parser.add_argument("--ttl", type=int, default=HEADER_TTL, help="seconds the header stays valid")
+    args = parser.parse_args()
+
+    print(header_value(args.path, args.ttl))
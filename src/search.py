@@ -0,0 +1,55 @@
+""" Prefix search on boat names and load items.
+    A lookup is a single equality query on the search tokens (src/search_tokens.py) instead of a scan.
+
+    Existing entities are indexed with: python -m src.search --reindex
+"""
+import argparse
+
+from google.cloud import datastore
+from src import search_tokens
+
+client = datastore.Client()
+
+
+def build_query(kind, q, owner=None):
+    """ Query for the entities where every word of q is a prefix of a word of the searched attribute.
+        Returns None when q has no searchable words.
+    """
+    terms = sorted(set(word[:search_tokens.MAX_PREFIX] for word in search_tokens.words(q)))
+    if not terms:
+        return None
+
+    query = client.query(kind=kind)
+    if owner is not None:
+        query.add_filter("owner", "=", owner)
+    for term in terms:
+        query.add_filter(search_tokens.FIELD, "=", term)
+    return query
+
+
+def reindex(kind, batch=500):
+    """ Recompute the search tokens of every entity of a kind."""
+    pending = []
+    indexed = 0
+    for entity in client.query(kind=kind).fetch():
+        pending.append(search_tokens.index(entity, kind))
+        if len(pending) >= batch:
+            client.put_multi(pending)
+            indexed += len(pending)
+            pending = []
+    if pending:
+        client.put_multi(pending)
+        indexed += len(pending)
+    return indexed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Maintain the boat and load search tokens")
+    parser.add_argument("--reindex", action="store_true", help="recompute the tokens of every boat and load")
+    args = parser.parse_args()
+
+    if args.reindex:
+        for each_kind in search_tokens.SEARCHED:
+            print(each_kind + ": " + str(reindex(each_kind)) + " entities indexed")
+    else:
+        parser.print_help()
@@ -0,0 +1,47 @@
+""" Search tokens stored on boats and loads.
+    Each boat and load stores the normalized prefixes of the words of its name (or item) as an indexed
+    list property, read by the queries in src/search.py. The property is internal and removed from every
+    response. Builds no datastore client, so offline tools like the seeder can import it.
+"""
+import re
+import unicodedata
+
+from src import constants
+
+FIELD = "search_tokens"
+
+# Words longer than this still match, only their first MAX_PREFIX characters are indexed
+MAX_PREFIX = 15
+
+# The attribute searched for each kind
+SEARCHED = {
+    constants.boats: "name",
+    constants.load: "item"
+}
+
+
+def words(text):
+    """ Lowercase words with accents stripped, e.g. "Écume-Rouge" gives ["ecume", "rouge"]."""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def tokens(text):
+    prefixes = set()
+    for word in words(text):
+        for end in range(1, min(len(word), MAX_PREFIX) + 1):
+            prefixes.add(word[:end])
+    return sorted(prefixes)
+
+
+def index(entity, kind):
+    """ Refresh the search tokens after the searched attribute was set or changed."""
+    entity[FIELD] = tokens(entity[SEARCHED[kind]])
+    return entity
+
+
+def hide(entity):
+    """ Drop the search tokens from an entity that is about to be returned."""
+    entity.pop(FIELD, None)
+    return entity
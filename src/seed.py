@@ -0,0 +1,182 @@
+""" Bulk data seeding for scale testing.
+    Generates users, boats and loads with a skewed owner distribution and writes them with chunked
+    put_multi calls from parallel workers. Point DATASTORE_EMULATOR_HOST at an emulator to seed it,
+    or use --backend memory to measure generation and batching without any datastore.
+
+    Usage: python -m src.seed --users 1000 --boats 100000 --loads 500000 --owner-skew 1.1
+"""
+import argparse
+import datetime
+import itertools
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import datastore
+from src import aggregate_fields
+from src import constants
+from src import search_tokens
+from src import sequence
+
+BOAT_TYPES = ["Sailboat", "Catamaran", "Yacht", "Trawler", "Tug", "Barge", "Ferry", "Dinghy"]
+ITEMS = ["Grain", "Timber", "Steel", "Coal", "Fruit", "Cars", "Textiles", "Machinery", "Fuel", "Salt"]
+
+# Datastore commits and id allocations are limited to 500 keys
+MAX_CHUNK = 500
+
+
+class MemoryStore:
+    """ Local stand-in for the datastore client with the calls the seeder uses."""
+    def __init__(self):
+        self.entities = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def key(self, kind, entity_id=None):
+        if entity_id is None:
+            return datastore.Key(kind, project="seed")
+        return datastore.Key(kind, entity_id, project="seed")
+
+    def allocate_ids(self, incomplete_key, num_ids):
+        with self.lock:
+            start = self.next_id
+            self.next_id += num_ids
+        return [incomplete_key.completed_key(entity_id) for entity_id in range(start, start + num_ids)]
+
+    def put_multi(self, entities):
+        with self.lock:
+            for entity in entities:
+                self.entities[entity.key.flat_path] = entity
+
+
+def allocate(client, kind, count):
+    keys = []
+    for start in range(0, count, MAX_CHUNK):
+        keys.extend(client.allocate_ids(client.key(kind), min(MAX_CHUNK, count - start)))
+    return keys
+
+
+def owner_picker(rng, owners, skew):
+    """ Zipf-like choice - the owner at rank r is picked with weight 1 / r ** skew."""
+    cum_weights = list(itertools.accumulate(1 / rank ** skew for rank in range(1, len(owners) + 1)))
+    return lambda: rng.choices(owners, cum_weights=cum_weights)[0]
+
+
+def loads_per_boat(rng, mean, distribution):
+    if distribution == "fixed":
+        return int(mean)
+    if mean <= 0:
+        return 0
+    # Geometric number of loads (0, 1, 2, ...) with the given mean, by inversion
+    success = 1 / (1 + mean)
+    return int(math.log(1 - rng.random()) / math.log(1 - success))
+
+
+def generate(client, args):
+    rng = random.Random(args.seed)
+    created = datetime.date(2022, 1, 1)
+
+    users = []
+    for user_key in allocate(client, constants.users, args.users):
+        user = datastore.entity.Entity(key=user_key)
+        user.update({"user_id": "seed|" + str(user_key.id)})
+        users.append(user)
+    pick_owner = owner_picker(rng, [user["user_id"] for user in users], args.owner_skew)
+
+    boats = []
+    for boat_key in allocate(client, constants.boats, args.boats):
+        boat = datastore.entity.Entity(key=boat_key)
+        boat_type = rng.choice(BOAT_TYPES)
+        boat.update({
+            "name": boat_type + " " + str(boat_key.id),
+            "type": boat_type,
+            "length": rng.randint(10, 400),
+            "owner": pick_owner()
+        })
+        boat.update(aggregate_fields.initial())
+        boats.append(search_tokens.index(boat, constants.boats))
+
+    # Fill boats in order until the loads run out, the rest stay unassigned
+    carriers = []
+    for boat in boats:
+        carriers.extend([boat.key.id] * loads_per_boat(rng, args.loads_per_boat, args.loads_distribution))
+        if len(carriers) >= args.loads:
+            break
+
+    loads = []
+    for index, load_key in enumerate(allocate(client, constants.load, args.loads)):
+        load = datastore.entity.Entity(key=load_key)
+        load.update({
+            "volume": rng.randint(1, 100),
+            "item": rng.choice(ITEMS),
+            "creation_date": (created + datetime.timedelta(days=rng.randint(0, 365))).isoformat(),
+            "carrier": {"id": carriers[index]} if index < len(carriers) else None,
+            "owner": pick_owner()
+        })
+        loads.append(search_tokens.index(load, constants.load))
+
+    boats_by_id = {boat.key.id: boat for boat in boats}
+    for each_load in loads:
+        if each_load["carrier"] is not None:
+            boat = boats_by_id[each_load["carrier"]["id"]]
+            boat["load_count"] += 1
+            boat["total_volume"] += each_load["volume"]
+
+    sequence.stamp(*boats, *loads)
+    return users, boats, loads
+
+
+def write(client, entities, chunk, workers):
+    """ Write the entities in chunks from parallel workers and return the seconds taken."""
+    chunks = [entities[start:start + chunk] for start in range(0, len(entities), chunk)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(client.put_multi, chunks))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed users, boats and loads for scale testing")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--boats", type=int, default=1000)
+    parser.add_argument("--loads", type=int, default=5000)
+    parser.add_argument("--owner-skew", type=float, default=1.0, help="zipf exponent, 0 for uniform owners")
+    parser.add_argument("--loads-per-boat", type=float, default=3, help="mean loads carried per boat")
+    parser.add_argument("--loads-distribution", choices=["geometric", "fixed"], default="geometric")
+    parser.add_argument("--chunk", type=int, default=MAX_CHUNK, help="entities per put_multi (max 500)")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--backend", choices=["datastore", "memory"], default="datastore")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for reproducible data")
+    args = parser.parse_args()
+
+    if min(args.users, args.boats, args.loads) < 0 or args.loads_per_boat < 0 or args.owner_skew < 0:
+        parser.error("counts, --loads-per-boat and --owner-skew can not be negative")
+    if args.users < 1 and (args.boats or args.loads):
+        parser.error("boats and loads need at least one user to own them")
+    if args.chunk < 1 or args.workers < 1:
+        parser.error("--chunk and --workers must be at least 1")
+
+    client = MemoryStore() if args.backend == "memory" else datastore.Client()
+    chunk = min(args.chunk, MAX_CHUNK)
+
+    start = time.perf_counter()
+    generated = generate(client, args)
+    print("Generated in " + str(round(time.perf_counter() - start, 2)) + "s")
+
+    total_entities = 0
+    total_seconds = 0
+    for kind, entities in zip((constants.users, constants.boats, constants.load), generated):
+        seconds = write(client, entities, chunk, args.workers)
+        total_entities += len(entities)
+        total_seconds += seconds
+        rate = round(len(entities) / seconds) if seconds else len(entities)
+        print(kind + ": " + str(len(entities)) + " entities in " + str(round(seconds, 2)) + "s (" + str(rate) + "/s)")
+
+    rate = round(total_entities / total_seconds) if total_seconds else total_entities
+    print("Total: " + str(total_entities) + " entities in " + str(round(total_seconds, 2)) + "s (" + str(rate) + "/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+""" Monotonic change sequence for the updated_at stamps read by the change feed.
+    Values are microseconds since the epoch, bumped past the last value handed out on this instance so
+    they never repeat or go backwards even if the wall clock does.
+"""
+import threading
+import time
+
+FIELD = "updated_at"
+
+last_value = 0
+lock = threading.Lock()
+
+
+def next_value():
+    global last_value
+    with lock:
+        last_value = max(time.time_ns() // 1000, last_value + 1)
+        return last_value
+
+
+def stamp(*entities):
+    """ Mark the entities as changed now, call before they are written."""
+    for entity in entities:
+        entity[FIELD] = next_value()
+    return entities
@@ -0,0 +1,129 @@
+""" Background task queue for cascade work that should not hold up the client.
+    Tasks run on an in-process worker thread. The interface follows Cloud Tasks: a task is a
+    named target with a JSON payload and an optional task id for deduplication, and the same
+    targets are served at POST /tasks/<name> so a Cloud Tasks queue can deliver them instead.
+    Handlers must be idempotent - failed tasks are retried with backoff.
+"""
+import collections
+import queue
+import threading
+import time
+
+from flask import Blueprint, request
+
+bp = Blueprint('tasks', __name__, url_prefix='/tasks')
+
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 1
+
+# Task ids remembered for deduplication, like Cloud Tasks task names
+MAX_TASK_IDS = 10000
+
+handlers = {}
+pending = queue.Queue()
+task_ids = collections.OrderedDict()
+lock = threading.Lock()
+worker = None
+
+metrics = {
+    "enqueued": 0,
+    "deduplicated": 0,
+    "completed": 0,
+    "retried": 0,
+    "failed": 0,
+    "items": {}
+}
+
+
+def handler(name):
+    """ Register a function taking the task payload as the target for name."""
+    def register(fn):
+        handlers[name] = fn
+        return fn
+    return register
+
+
+def progress(name, count):
+    """ Record the number of items a task has processed."""
+    with lock:
+        metrics["items"][name] = metrics["items"].get(name, 0) + count
+
+
+def get_metrics():
+    with lock:
+        output = dict(metrics)
+        output["items"] = dict(metrics["items"])
+    output["pending"] = pending.qsize()
+    return output
+
+
+def enqueue(name, payload, task_id=None):
+    """ Queue a task. Returns False if a task with the same id was already queued."""
+    global worker
+    if name not in handlers:
+        raise KeyError("No task handler named " + name)
+
+    with lock:
+        if task_id is not None:
+            if task_id in task_ids:
+                metrics["deduplicated"] += 1
+                return False
+            task_ids[task_id] = True
+            if len(task_ids) > MAX_TASK_IDS:
+                task_ids.popitem(last=False)
+
+        metrics["enqueued"] += 1
+        if worker is None or not worker.is_alive():
+            worker = threading.Thread(target=work, name="tasks", daemon=True)
+            worker.start()
+
+    pending.put((name, payload, task_id, 1))
+    return True
+
+
+def work():
+    while True:
+        name, payload, task_id, attempt = pending.get()
+        try:
+            handlers[name](payload)
+            with lock:
+                metrics["completed"] += 1
+        except Exception:
+            if attempt >= MAX_ATTEMPTS:
+                # Forget the id so the task can be queued again later
+                with lock:
+                    metrics["failed"] += 1
+                    task_ids.pop(task_id, None)
+            else:
+                with lock:
+                    metrics["retried"] += 1
+                delay = BACKOFF_SECONDS * 2 ** (attempt - 1)
+                retry = threading.Timer(delay, pending.put, args=((name, payload, task_id, attempt + 1),))
+                retry.daemon = True
+                retry.start()
+        finally:
+            pending.task_done()
+
+
+@bp.route('/<name>', methods=['POST'])
+def run_task(name):
+    """ Cloud Tasks delivery target.
+        App Engine strips the queue name headers from external requests, so they prove the caller.
+    """
+    if 'X-AppEngine-QueueName' not in request.headers and 'X-CloudTasks-QueueName' not in request.headers:
+        error_message = {
+            "Error": "Tasks can only be sent by the task queue"
+        }
+        return error_message, 403
+
+    if name not in handlers:
+        error_message = {
+            "Error": "No task handler with this name exists"
+        }
+        return error_message, 404
+
+    # Any exception is a 500, which makes Cloud Tasks retry
+    handlers[name](request.get_json())
+    with lock:
+        metrics["completed"] += 1
+    return '', 204
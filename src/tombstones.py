@@ -0,0 +1,63 @@
+""" Tombstones for deleted entities.
+    A delete commits the tombstone together with the delete itself and leaves the cascade to a
+    background task. Until the cascade has run, references to a tombstoned entity are treated as absent.
+    Tombstones are kept after the cascade as the delete records of the change feed.
+"""
+import datetime
+
+from google.cloud import datastore
+from src import constants
+
+client = datastore.Client()
+
+
+def tombstone_key(kind, entity_id):
+    return client.key(constants.tombstones, kind + ":" + str(entity_id))
+
+
+def create(kind, entity_id, owner, cascade=True):
+    """ Build the tombstone entity to be written with the delete. Deletes without a cascade pass cascade=False."""
+    tombstone = datastore.entity.Entity(key=tombstone_key(kind, entity_id))
+    tombstone.update({
+        "entity_kind": kind,
+        "entity_id": entity_id,
+        "owner": owner,
+        "deleted_at": datetime.datetime.now(datetime.timezone.utc),
+        "cascade_pending": cascade
+    })
+    return tombstone
+
+
+def finish(kind, entity_id):
+    """ Mark the cascade of a tombstone as done."""
+    tombstone = client.get(tombstone_key(kind, entity_id))
+    if tombstone is not None and tombstone["cascade_pending"]:
+        tombstone["cascade_pending"] = False
+        client.put(tombstone)
+
+
+def pending(kind):
+    """ Tombstones whose cascade has not finished, e.g. after an instance was shut down."""
+    query = client.query(kind=constants.tombstones)
+    query.add_filter("entity_kind", "=", kind)
+    query.add_filter("cascade_pending", "=", True)
+    return list(query.fetch())
+
+
+def dead(kind, entity_ids):
+    """ Return the ids out of entity_ids that have been deleted."""
+    entity_ids = set(entity_ids)
+    if not entity_ids:
+        return set()
+    found = client.get_multi([tombstone_key(kind, entity_id) for entity_id in entity_ids])
+    return set(tombstone["entity_id"] for tombstone in found)
+
+
+def hide_dead_carriers(loads):
+    """ Show loads carried by a deleted boat as unassigned while the cascade catches up."""
+    carried = [each_load for each_load in loads if each_load["carrier"] is not None]
+    deleted = dead(constants.boats, [each_load["carrier"]["id"] for each_load in carried])
+    for each_load in carried:
+        if each_load["carrier"]["id"] in deleted:
+            each_load["carrier"] = None
+    return loads
@@ -0,0 +1,178 @@
+""" Request scoped unit of work.
+    Handlers register dirty entities and deleted keys instead of writing them one by one. Everything
+    is written in one put_multi/delete_multi once the handler has returned a successful response,
+    optionally inside a transaction. Repeated writes to the same key keep the last one.
+    Counters are changed with increment, which reads the stored entity inside the transaction so
+    concurrent requests never lose each other's changes. Every entity written is stamped for the change feed.
+    Writes that depend on what the handler read register it with expect, and the request fails with a
+    conflict instead of writing if another request changed it in between.
+"""
+import copy
+
+from flask import Blueprint, g, make_response
+from google.api_core import exceptions
+from google.cloud import datastore
+from src import sequence
+
+client = datastore.Client()
+bp = Blueprint('unit_of_work', __name__)
+
+# Datastore commits are limited to 500 mutations
+MAX_BATCH = 500
+
+
+class Conflict(Exception):
+    def __init__(self, error, status_code=409):
+        self.error = error
+        self.status_code = status_code
+
+
+def plain(value):
+    """ Embedded entities as plain dicts so stored and read values compare equal."""
+    if isinstance(value, dict):
+        return {name: plain(item) for name, item in value.items()}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    return value
+
+
+def snapshot(entity):
+    """ Copy the entity as registered so response only fields (id, self) added later are never stored."""
+    entity_copy = datastore.entity.Entity(key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+    entity_copy.update(copy.deepcopy(dict(entity)))
+    return entity_copy
+
+
+class UnitOfWork:
+    def __init__(self):
+        self.puts = {}
+        self.deletes = {}
+        self.keeps = {}
+        self.increments = {}
+        self.expects = {}
+        self.stored = {}
+        self.callbacks = []
+        self.transactional = False
+
+    def put(self, entity, keep=()):
+        """ keep names attributes maintained by increment - their stored value wins over the one read by the handler."""
+        if entity.key is None or entity.key.is_partial:
+            raise ValueError("New entities need their ID before the response, put them directly")
+        path = entity.key.flat_path
+        self.deletes.pop(path, None)
+        # Stamped on the handler's entity too so the response shows the new updated_at
+        sequence.stamp(entity)
+        self.puts[path] = snapshot(entity)
+        if keep:
+            self.keeps[path] = tuple(keep)
+            self.transactional = True
+
+    def delete(self, key):
+        path = key.flat_path
+        self.puts.pop(path, None)
+        self.keeps.pop(path, None)
+        self.increments.pop(path, None)
+        self.deletes[path] = key
+
+    def increment(self, key, **deltas):
+        """ Add the deltas to numeric attributes of a stored entity. Always transactional.
+            Entities that no longer exist at flush are skipped.
+        """
+        path = key.flat_path
+        if path in self.deletes:
+            return
+        pending = self.increments.setdefault(path, (key, {}))[1]
+        for name, delta in deltas.items():
+            pending[name] = pending.get(name, 0) + delta
+        self.transactional = True
+
+    def expect(self, key, values, error="The data was changed by another request, try again", status_code=409):
+        """ Fail the flush with error unless the stored entity still has these attribute values. Always transactional."""
+        self.expects[key.flat_path] = (key, plain(values), error, status_code)
+        self.transactional = True
+
+    def merge_stored(self):
+        """ Read the expected, kept and incremented entities (inside the transaction).
+            Raises Conflict if an expected entity changed, otherwise folds the stored values into the puts.
+        """
+        keys = {path: self.puts[path].key for path in self.keeps}
+        keys.update((path, key) for path, (key, _) in self.increments.items())
+        keys.update((path, key) for path, (key, *_) in self.expects.items())
+        if not keys:
+            return
+        stored = {entity.key.flat_path: entity for entity in client.get_multi(list(keys.values()))}
+        self.stored = {path: snapshot(entity) for path, entity in stored.items()}
+
+        for path, (key, values, error, status_code) in self.expects.items():
+            entity = stored.get(path)
+            if entity is None or any(plain(entity.get(name)) != value for name, value in values.items()):
+                raise Conflict(error, status_code)
+
+        for path, names in self.keeps.items():
+            if path in stored:
+                for name in names:
+                    if name in stored[path]:
+                        self.puts[path][name] = stored[path][name]
+
+        for path, (key, deltas) in self.increments.items():
+            entity = self.puts.get(path, stored.get(path))
+            if entity is None:
+                continue
+            for name, delta in deltas.items():
+                entity[name] = (entity.get(name) or 0) + delta
+            if path not in self.puts:
+                sequence.stamp(entity)
+            self.puts[path] = entity
+
+    def stored_entity(self, key):
+        """ The entity as read inside the flush transaction, for on_commit callbacks. None if it was not read."""
+        return self.stored.get(key.flat_path)
+
+    def on_commit(self, callback):
+        """ Run callback once the writes are committed, e.g. to queue follow up work."""
+        self.callbacks.append(callback)
+
+    def flush(self):
+        if self.transactional:
+            with client.transaction():
+                self.merge_stored()
+                client.put_multi(list(self.puts.values()))
+                client.delete_multi(list(self.deletes.values()))
+        else:
+            puts = list(self.puts.values())
+            deletes = list(self.deletes.values())
+            for start in range(0, len(puts), MAX_BATCH):
+                client.put_multi(puts[start:start + MAX_BATCH])
+            for start in range(0, len(deletes), MAX_BATCH):
+                client.delete_multi(deletes[start:start + MAX_BATCH])
+        self.puts, self.deletes, self.keeps, self.increments, self.expects = {}, {}, {}, {}, {}
+
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+def current(transactional=False):
+    """ The unit of work of the current request. Any transactional caller makes the whole flush transactional."""
+    if 'unit_of_work' not in g:
+        g.unit_of_work = UnitOfWork()
+    if transactional:
+        g.unit_of_work.transactional = True
+    return g.unit_of_work
+
+
+@bp.after_app_request
+def flush(response):
+    """ Write once the response is ready - a failed flush still turns the response into a 500.
+        A conflict with a concurrent request replaces the response with the error, nothing is written.
+    """
+    unit = g.pop('unit_of_work', None)
+    if unit is not None and response.status_code < 400:
+        try:
+            unit.flush()
+        except Conflict as error:
+            return make_response(({"Error": error.error}, error.status_code))
+        except (exceptions.Conflict, exceptions.Aborted):
+            # Datastore contention, another transaction committed the same entities first
+            return make_response(({"Error": "The data was changed by another request, try again"}, 409))
+    return response
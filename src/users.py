@@ -1,37 +1,109 @@
-from flask import Blueprint, request
+import asyncio
+
+from flask import Blueprint, g, request
 from google.cloud import datastore
+from src import carriers
 from src import constants
+from src import gate
+from src import pool
+from src import search_tokens
+from src import tombstones
 
 client = datastore.Client()
 bp = Blueprint('users', __name__, url_prefix='/users')
 
 
 @bp.route('', methods=['POST', 'GET', 'PATCH', 'DELETE', 'PUT'])
+@gate.guard(['GET'])
 def users_get():
     """ Return all the users currently stored in the database"""
-    # Check accept header for json
-    if 'application/json' not in request.accept_mimetypes:
-        error_message = {
-            "Error": "Client must accept valid JSON"
-        }
-        return error_message, 406
-
-    if request.method == 'GET':
-        query = client.query(kind=constants.users)
-
-        results = list(query.fetch())
-
-        output = []
-        for each_item in results:
-            output.append({
-                "id": each_item.key.id,
-                "user_id": each_item["user_id"]
-            })
-
-        return {"users": output}, 200
-
-    else:
-        error_message = {
-            "Error": "Method not allowed"
-        }
-        return error_message, 405
+    query = client.query(kind=constants.users)
+
+    results = list(query.fetch())
+
+    output = []
+    for each_item in results:
+        output.append({
+            "id": each_item.key.id,
+            "user_id": each_item["user_id"]
+        })
+
+    return {"users": output}, 200
+
+
+def show_load(each_load, host_url):
+    """ Add the id and self links to a load of the summary."""
+    search_tokens.hide(each_load)
+    each_load["id"] = each_load.key.id
+    each_load["self"] = host_url + "loads/" + str(each_load.key.id)
+    if each_load["carrier"] is not None:
+        each_load["carrier"]["self"] = host_url + "boats/" + str(each_load["carrier"]["id"])
+    return each_load
+
+
+@bp.route('/me/summary', methods=['GET', 'POST', 'PATCH', 'DELETE', 'PUT'])
+@gate.guard(['GET'], login=['GET'])
+async def owner_summary():
+    """ Boats, loads and totals of the logged in owner in one response.
+        Each boat lists every load it carries, including loads of other owners. The unassigned loads,
+        the loads on other boats and the totals only count the user's own loads.
+    """
+    payload = g.jwt_payload
+
+    boat_query = client.query(kind=constants.boats)
+    boat_query.add_filter("owner", "=", payload["sub"])
+    load_query = client.query(kind=constants.load)
+    load_query.add_filter("owner", "=", payload["sub"])
+
+    # Both owner queries are independent
+    boats_results, loads_results = await asyncio.gather(
+        pool.run(lambda: list(boat_query.fetch())),
+        pool.run(lambda: list(load_query.fetch()))
+    )
+
+    # Any owner can load a boat, so read what each of the user's boats carries as well
+    carried_results = await asyncio.gather(
+        *(pool.run(list, carriers.carried_query(each_boat.key.id).fetch()) for each_boat in boats_results)
+    )
+
+    # Loads on deleted boats are unassigned even if the cascade has not reached them yet
+    await pool.run(tombstones.hide_dead_carriers, loads_results)
+
+    # Index the loads by their carrier so each boat picks up its loads in one lookup
+    loads_by_boat = {}
+    unassigned = []
+    assigned_volume = 0
+    for each_load in loads_results:
+        show_load(each_load, request.host_url)
+        if each_load["carrier"] is None:
+            unassigned.append(each_load)
+        else:
+            loads_by_boat.setdefault(each_load["carrier"]["id"], []).append(each_load)
+            assigned_volume += each_load["volume"]
+
+    # The user's own loads were indexed above, add the loads of other owners
+    for carried in carried_results:
+        for each_load in carried:
+            if each_load["owner"] != payload["sub"]:
+                show_load(each_load, request.host_url)
+                loads_by_boat.setdefault(each_load["carrier"]["id"], []).append(each_load)
+
+    for each_boat in boats_results:
+        search_tokens.hide(each_boat)
+        each_boat["id"] = each_boat.key.id
+        each_boat["self"] = request.host_url + "boats/" + str(each_boat.key.id)
+        each_boat["loads"] = loads_by_boat.pop(each_boat.key.id, [])
+
+    # Whatever is left is carried by boats of other owners
+    other_boats = [each_load for boat_loads in loads_by_boat.values() for each_load in boat_loads]
+
+    output = {
+        "boats": boats_results,
+        "unassigned_loads": unassigned,
+        "loads_on_other_boats": other_boats,
+        "boat_count": len(boats_results),
+        "load_count": len(loads_results),
+        "assigned_volume": assigned_volume
+    }
+
+    return output, 200
@@ -0,0 +1,54 @@
+""" App Engine warmup request.
+    Runs before an instance receives traffic so the first real request does not pay for
+    datastore channels, the JWKS download, the Auth0 TLS handshake or template compilation.
+"""
+import time
+
+from flask import Blueprint, current_app
+from src import constants
+from src import auth, boats, load, users, carriers
+from src import pool
+
+bp = Blueprint('warmup', __name__)
+
+
+def warm_client(client):
+    """ A keys only query opens the datastore channel of the client."""
+    query = client.query(kind=constants.users)
+    query.keys_only()
+    list(query.fetch(limit=1, timeout=10))
+
+
+def warm_pool():
+    """ Start every pool thread up front."""
+    futures = [pool.executor.submit(time.sleep, 0.01) for each_thread in range(pool.POOL_SIZE)]
+    for each_future in futures:
+        each_future.result()
+
+
+@bp.route('/_ah/warmup', methods=['GET'])
+def warmup():
+    """ Prime the shared clients and caches and report how long each step took."""
+    steps = [
+        ("datastore", lambda: [warm_client(module.client) for module in (auth, boats, load, users, carriers)]),
+        ("jwks", lambda: auth.get_jwks(refresh=True)),
+        ("templates", lambda: current_app.jinja_env.get_template('welcome.html')),
+        ("pool", warm_pool),
+        ("tasks", carriers.resume_pending)
+    ]
+
+    timings = {}
+    errors = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as error:
+            # A failed step is left for the first request to retry
+            errors[name] = str(error)
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+
+    output = {"timings_ms": timings}
+    if errors:
+        output["errors"] = errors
+    return output, 200